@@ -5,13 +5,36 @@
 # Tested on LCA50-025-72F actuator
 
 
-import csv
+import re
 import time
+import threading
+import warnings
 from pathlib import Path
-from glob import glob
+from glob import glob, escape
 from math import pi
 from lac1 import LAC1
+from crush_io import CrushWriter, SampleBuffer, HEADER, RAW_HEADER
+import crush_cal
+from functools import partial
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+PROTOCOLS = ('stop', 'hold', 'multi_stop', 'multi_hold', 'long_stop',
+             'no_stop')
+start_height = 20  # mm
+rig = None  # used by protocols when not given a rig, set by init
+FORCE_TABLE = crush_cal.latest().table()
+
+
+def get_rig(selected=None):
+    """
+    Returns the selected rig, or the module rig if none is selected.
+    """
+    if selected is not None:
+        return selected
+    assert rig is not None, 'Connect to a rig before running protocols'
+    return rig
 
 
 def connect(port, silent=True):
@@ -35,118 +58,256 @@ def disconnect(rig):
     rig.close()
 
 
-def convert_force(voltage):
+def convert_force(voltage, table=FORCE_TABLE):
     """
-    Formula used to convert sensor data voltage reading into Newtons as per
-    predetermined sensor calibration curve
-
-    Calibration curve - Oct 24 2018
-    grams   N       voltage
-    0       0.000   298.7
-    100     0.981   334.2
-    300     2.943   405.9
-    500     4.905   477.5
-    800     7.848   585.1
-    1000    9.810   656.5
-    1200    11.77   728.5
-    R^2 = 1
-    y = 0.0274x - 8.175
-
-    Calibration curve - Feb 19 2019
-    grams   N       voltage
-    0       0.000   305.4
-    100     0.981   341.2
-    300     2.943   413.0
-    500     4.905   484.2
-    800     7.848   592.6
-    1000    9.810   664.6
-    1200    11.77   735.6
-    R^2 = 1
-    y = 0.02733x - 8.3447
-    Shift of approximately 0.17 N (17.3 g)
+    Converts sensor data voltage reading into Newtons as per predetermined
+    sensor calibration curve, looked up in a table of the force at every
+    reading (see crush_cal for the calibrations)
     """
+    return table[int(voltage)]
 
-    return round(0.02733 * int(voltage) - 8.3447, 6)
+
+def extrapolate(history, when, order=1):
+    """
+    Returns the value at time when extrapolated from a least squares line
+    (order 1) or parabola (order 2) through the (time, value) pairs in
+    history, times in ns. Uses a lower order if there are too few pairs.
+    """
+    order = min(order, len(history) - 1)
+    last_time, last_value = history[-1]
+    if order < 1:
+        return last_value
+
+    # Fit in seconds from the last sample to keep the sums well scaled
+    times = [(t - last_time) / 1e9 for t, _ in history]
+    values = [value for _, value in history]
+    size = order + 1
+    sums = [sum(t ** k for t in times) for k in range(2 * order + 1)]
+    rows = [[sums[i + j] for j in range(size)] +
+            [sum(v * t ** i for t, v in zip(times, values))]
+            for i in range(size)]
+
+    # Solve the normal equations by gaussian elimination
+    for col in range(size):
+        pivot = max(range(col, size), key=lambda row: abs(rows[row][col]))
+        if abs(rows[pivot][col]) < 1e-12:
+            return last_value  # repeated times, no trend to follow
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        for row in range(col + 1, size):
+            scale = rows[row][col] / rows[col][col]
+            rows[row] = [a - scale * b for a, b in zip(rows[row], rows[col])]
+    coefs = [0.0] * size
+    for row in reversed(range(size)):
+        known = sum(rows[row][k] * coefs[k] for k in range(row + 1, size))
+        coefs[row] = (rows[row][size] - known) / rows[row][row]
+
+    dt = (when - last_time) / 1e9
+    return sum(coef * dt ** k for k, coef in enumerate(coefs))
+
+
+class Acquisition(threading.Thread):
+    """
+    Samples the rig from a background thread that is the only user of the
+    serial port while running. Timestamped samples are published to a queue
+    and commands queued by the control loop are sent between samples, so
+    slow processing in the control loop does not delay sampling.
+    Every sample is kept until read, a warning is given if more than size
+    samples are waiting as the control loop is falling behind.
+    """
+
+    def __init__(self, rig, size=10000):
+        super().__init__(daemon=True)
+        self.rig = rig
+        self.error = None
+        self._size = size
+        self._warned = False
+        # deque appends and pops are atomic so no locks are needed
+        self._samples = deque()
+        self._commands = deque()
+        self._ready = threading.Event()
+        self._finished = threading.Event()
+
+    def command(self, func, *args, **kwargs):
+        """
+        Queues func(*args, **kwargs) to be called before the next sample.
+        """
+        self._commands.append((func, args, kwargs))
+
+    def read(self, timeout=30):
+        """
+        Returns the oldest unread (time in ns, sample), waiting for one if
+        needed, timed as by LAC1.read_movement_and_force.
+        """
+        while not self._samples:
+            self._ready.clear()
+            if self._samples:
+                break
+            if self.error is not None:
+                raise self.error
+            if not self._ready.wait(timeout):
+                raise Exception('Acquisition read timed out')
+        return self._samples.popleft()
+
+    def run(self):
+        try:
+            while not self._finished.is_set():
+                while self._commands:
+                    func, args, kwargs = self._commands.popleft()
+                    func(*args, **kwargs)
+                sample = self.rig.read_movement_and_force()
+                self._samples.append((self.rig.sample_ns, sample))
+                self._ready.set()
+                if len(self._samples) > self._size and not self._warned:
+                    warnings.warn(f'Acquisition has over {self._size} '
+                                  'unread samples, the control loop is '
+                                  'falling behind')
+                    self._warned = True
+        except Exception as error:
+            self.error = error
+            self._ready.set()
+
+    def stop(self):
+        """
+        Sends any queued commands then stops sampling.
+        """
+        self._finished.set()
+        self.join()
+        while self._commands:
+            func, args, kwargs = self._commands.popleft()
+            func(*args, **kwargs)
 
 
 def single_crush(target_force, target_action='stop', duration=10,
-                 start_time=None, multi=False):
+                 start_time=None, multi=False, stream_interval=None,
+                 threaded=False, rig=None, progress=None, sink=None,
+                 raw=False):
     """
     Will execute a crush until target force is met, then will either 'stop'
     or 'hold' for duration. Logs data throughout until returned to start.
+    Rows are timed in ns from start_time, a time.perf_counter_ns() value
+    that defaults to the start of the crush, at the midpoint of each query.
+    Rows hold force in N, or the force sensor reading if raw is True, for
+    conversion when read with a calibration (see crush_io.RAW_HEADER).
+    Data rows are appended to a SampleBuffer which is returned, or to sink
+    (e.g. a CrushWriter) if given.
+    If stream_interval is given in ms, samples are streamed by the LAC-1 at
+    that interval instead of requested on each iteration.
+    If threaded is True, sampling runs in an Acquisition thread and the
+    stage logic queues its commands to it.
+    Runs on the module rig unless a rig is given. If progress is given it is
+    called with the stage and number of samples after each sample.
+    The target action is sent once the force extrapolated from recent
+    samples to when the command would take effect reaches target_force.
     """
 
     # Settings
-    data = []
+    data = sink
+    if data is None:
+        data = SampleBuffer(RAW_HEADER if raw else HEADER)
     window = 3
     forces = deque([0], maxlen=window)
     force_res_limit = max(0.02 * target_force, 0.1)  # aim for +/-1% error
     crush_velocity = 1.0  # mm/s
     min_velocity = crush_velocity * (2 ** -3)
     pos_margin = 0.1  # mm
-    # Knockdown force extrapolation by factor if stopping at target
-    if target_action == 'stop':
-        knockdown = 0.25
-    else:
-        knockdown = 1
+    # Force at target is predicted by a fit over recent samples
+    history = deque(maxlen=5)  # (time in ns, force)
+    fit_order = 1  # 1 for linear or 2 for quadratic
+    round_trip = None  # ns, latest query round trip
 
     # rig is at start height prior to protocol
+    rig = get_rig(rig)
     rig.set_mode('action')
     start_pos = rig.read_position()
     if start_time is None:
-        start_time = time.time()
+        start_time = time.perf_counter_ns()
 
     # Start moving
     rig.move_const_vel(toward_home=True)
+    if stream_interval is not None:
+        rig.start_stream(stream_interval)
+
+    # Sample and send commands directly or through the acquisition thread
+    if threaded:
+        acquisition = Acquisition(rig)
+        acquisition.start()
+        read = acquisition.read
+        send = acquisition.command
+    else:
+        def read():
+            sample = rig.read_movement_and_force()
+            return rig.sample_ns, sample
+
+        def send(func, *args, **kwargs):
+            func(*args, **kwargs)
 
     stage = 0  # 0 for approach, 1 for crush, 2 for target, 3 for release
     done = False
     contact_threshold = 0.05
     contact_count = 0
-    while not done:
-        samples = rig.read_movement_and_force()
-        samples[2] = convert_force(samples[2])
-        forces.append(samples[2])
-
-        if stage == 0:
-            if sum(forces) / window >= contact_threshold:  # contact
-                contact_count += 1
-            elif contact_count:
-                contact_count = 0  # reset if contact falls below threshold
-
-            if contact_count > window:  # hysteresis
-                rig.set_max_velocity(crush_velocity)
-                print('Tissue contact made..')
-                stage += 1
-
-        elif stage == 1:
-            delta_force = forces[-1] - forces[-2]
-            # Try to predict next value if stopped now
-            if forces[-1] >= target_force - (delta_force * knockdown):
-                if target_action == 'stop':
-                    rig.stop()
-                elif target_action == 'hold':
-                    rig.move_const_torque(samples[3])
-                target_time = time.time()
-                print('Target force achieved..')
+    try:
+        while not done:
+            timestamp, samples = read()
+            voltage = int(samples[2])
+            forces.append(convert_force(voltage))
+            history.append((timestamp, forces[-1]))
+            samples[2] = voltage if raw else forces[-1]
+
+            if stage == 0:
+                if sum(forces) / window >= contact_threshold:  # contact
+                    contact_count += 1
+                elif contact_count:
+                    contact_count = 0  # reset if contact below threshold
+
+                if contact_count > window:  # hysteresis
+                    send(rig.set_max_velocity, crush_velocity)
+                    print('Tissue contact made..')
+                    stage += 1
+
+            elif stage == 1:
+                delta_force = forces[-1] - forces[-2]
+                if rig.sent_ns is not None and rig.reply_ns is not None and (
+                        rig.reply_ns > rig.sent_ns):
+                    round_trip = rig.reply_ns - rig.sent_ns
+                elif round_trip is None and len(history) > 1:
+                    round_trip = history[-1][0] - history[-2][0]
+                # Predict force when a command sent now takes effect, half
+                # a round trip away or a full one more if queued behind
+                # the next query by the acquisition thread
+                latency = (round_trip or 0) * (1.5 if threaded else 0.5)
+                arrival = time.perf_counter_ns() + latency
+                if extrapolate(history, arrival, fit_order) >= target_force:
+                    if target_action == 'stop':
+                        send(rig.stop)
+                    elif target_action == 'hold':
+                        send(rig.move_const_torque, samples[3])
+                    target_time = time.time()
+                    print('Target force achieved..')
+                    stage += 1
+
+                # Slow down if force resolution becomes poor
+                elif samples[1] > min_velocity and (abs(delta_force) >
+                                                    force_res_limit):
+                    send(rig.set_max_velocity,
+                         max(abs(samples[1]) / 2, min_velocity))
+
+            elif stage == 2 and (time.time() - target_time) >= duration:
+                send(rig.set_mode, 'action')
+                send(rig.move_clear, start_height)
+                print('Crush complete')
                 stage += 1
 
-            # Slow down if force resolution becomes poor
-            elif samples[1] > min_velocity and (abs(delta_force) >
-                                                force_res_limit):
-                rig.set_max_velocity(max(abs(samples[1]) / 2, min_velocity))
+            elif stage == 3:
+                if abs(samples[0] - start_pos) < pos_margin:
+                    done = True
 
-        elif stage == 2 and (time.time() - target_time) >= duration:
-            rig.set_mode('action')
-            rig.move_clear(start_height)
-            print('Crush complete')
-            stage += 1
-
-        elif stage == 3:
-            if abs(samples[0] - start_pos) < pos_margin:
-                done = True
-
-        data.append((round(time.time() - start_time, 6), *samples, stage))
+            data.append((timestamp - start_time, *samples, stage))
+            if progress is not None:
+                progress(stage, len(data))
+    finally:
+        if threaded:
+            acquisition.stop()
+        rig.stop_stream()
 
     if multi:
         return data, target_time
@@ -154,20 +315,26 @@ def single_crush(target_force, target_action='stop', duration=10,
 
 
 def multi_crush(target_force, num_crushes=5, target_action='stop',
-                duration=10, duty_cycle=0.5):
+                duration=10, duty_cycle=0.5, stream_interval=None,
+                threaded=False, rig=None, progress=None, sink=None,
+                raw=False):
     """
     Will execute a number of crushes at a set duty cycle, will either 'stop'
     or 'hold' for duration once target force achieved. Logs data throughout.
+    Data is returned as from single_crush.
     """
 
     pause = duration * ((1 - duty_cycle) / duty_cycle)
-    data = []
-    start_time = time.time()
+    data = sink
+    if data is None:
+        data = SampleBuffer(RAW_HEADER if raw else HEADER)
+    start_time = time.perf_counter_ns()
     for i in range(num_crushes):
         cycle_start_time = time.time()
-        new_data, last_target_time = single_crush(
-            target_force, target_action, duration, start_time, True)
-        data += new_data
+        _, last_target_time = single_crush(
+            target_force, target_action, duration, start_time, multi=True,
+            stream_interval=stream_interval, threaded=threaded, rig=rig,
+            progress=progress, sink=data, raw=raw)
 
         if i == num_crushes - 1:
             continue
@@ -195,6 +362,75 @@ def to_pressure(force, diameter=5):
     return 1000 * force / area
 
 
+def run_protocol(protocol, target_force, **kwargs):
+    """
+    Executes the named crush protocol at target force and returns the data.
+    Keyword arguments are passed to single_crush or multi_crush.
+    """
+    if protocol == 'stop':
+        data = single_crush(target_force, **kwargs)
+
+    elif protocol == 'hold':
+        data = single_crush(target_force, target_action='hold', **kwargs)
+
+    elif protocol == 'multi_stop':
+        data = multi_crush(target_force, **kwargs)
+
+    elif protocol == 'multi_hold':
+        data = multi_crush(target_force, target_action='hold', **kwargs)
+
+    elif protocol == 'long_stop':
+        data = single_crush(target_force, duration=60, **kwargs)
+
+    elif protocol == 'no_stop':
+        data = single_crush(target_force, duration=0.1, **kwargs)
+
+    else:
+        raise ValueError(f'Unknown protocol {protocol}')
+
+    return data
+
+
+def summarize(protocol, data, elapsed):
+    """
+    Returns the sample count, average sample rate in Hz and duration in s of
+    a protocol run, printing a one line summary.
+    """
+    count = len(data)
+    span = (data[-1][0] - data[0][0]) / 1e9 if count > 1 else 0
+    rate = (count - 1) / span if span > 0 else 0.0
+    print(f'{protocol}: {count} samples at {rate:.1f} Hz, '
+          f'completed in {elapsed:.2f} s')
+    return count, rate, elapsed
+
+
+def get_filepath(protocol, target_weight, folder=None):
+    """
+    Returns a path for the data of a protocol in folder (current directory by
+    default), with a version number added to avoid overwriting files.
+    """
+    if folder is None:
+        folder = Path.cwd()
+    filename = f"{protocol}-{target_weight}g.csv"
+    filepath = Path(folder).joinpath(filename)
+
+    # Prevent overwriting of files, versioning only files with the suffix
+    # as columnar recordings leave a folder of the same name alongside
+    if filepath.is_file():
+        pattern = str(filepath.parent.joinpath(escape(filepath.stem) + '*' +
+                                               filepath.suffix))
+        version = re.compile(re.escape(filepath.stem) + r'-(\d+)$')
+        max_version = 1
+        for file in glob(pattern):
+            match = version.match(Path(file).stem)
+            if match:
+                max_version = max(max_version, int(match.group(1)))
+        filepath = filepath.parent.joinpath(filepath.stem +
+                                            f'-{(max_version + 1):02}' +
+                                            filepath.suffix)
+    return filepath
+
+
 def get_selection(items, name='Item'):
     name = name[0].upper() + name[1:]
     for i, item in enumerate(items):
@@ -223,7 +459,7 @@ def init(rig=None, debug=False):
         print('Input serial port number to connect:')
         port = get_selection(port_options, 'Port')
         rig = connect(port, silent=(not debug))
-        return rig
+    return rig
 
 
 def crush(rig=None):
@@ -232,10 +468,8 @@ def crush(rig=None):
     rig = init(rig)
 
     # Get crush settings from user
-    protocol_names = ('stop', 'hold', 'multi_stop', 'multi_hold',
-                      'long_stop', 'no_stop')
     print('Select a protocol:')
-    protocol = get_selection(protocol_names, 'Protocol')
+    protocol = get_selection(PROTOCOLS, 'Protocol')
 
     max_weight = 5000  # limit to 5 kg load
     target_weight = abs(float(input('Input target load in grams: ')))
@@ -244,61 +478,99 @@ def crush(rig=None):
 
     # Select file to write csv data
     print('Storing crush data in current directory')
-    filename = f"{protocol}-{target_weight}g.csv"
-    filepath = Path.cwd().joinpath(filename)
-
-    # Prevent overwriting of files
-    if filepath.is_file():
-        path_no_suffix = str(Path.joinpath(filepath.parent,
-                                           filepath.stem)) + '*'
-        matching_files = glob(path_no_suffix)
-        max_version = 1
-        for file in matching_files:
-            if file == str(filepath):
-                continue
-            max_version = max(max_version, int(Path(file).stem[-2:]))
-        filepath = Path.cwd().joinpath(filepath.stem +
-                                       f'-{(max_version + 1):02}' +
-                                       filepath.suffix)
+    filepath = get_filepath(protocol, target_weight)
 
     # Wait for go ahead
     cmd = input("Press enter to run protocol or 'x' to exit: ")
     if cmd.strip().lower() == 'x':
         return
 
-    # Execute crush protocol
-    with filepath.open('w', newline='') as file:
-        writer = csv.writer(file)
-
-        if protocol == 'stop':
-            data = single_crush(target_force)
-
-        elif protocol == 'hold':
-            data = single_crush(target_force, target_action='hold')
-
-        elif protocol == 'multi_stop':
-            data = multi_crush(target_force)
+    # Execute crush protocol, writing sensor readings as they are recorded
+    with CrushWriter(filepath, header=RAW_HEADER, columnar=True) as data:
+        protocol_start = time.perf_counter()
+        run_protocol(protocol, target_force, rig=rig, sink=data, raw=True)
+        summarize(protocol, data, time.perf_counter() - protocol_start)
 
-        elif protocol == 'multi_hold':
-            data = multi_crush(target_force, target_action='hold')
 
-        elif protocol == 'long_stop':
-            data = single_crush(target_force, duration=60)
-
-        elif protocol == 'no_stop':
-            data = single_crush(target_force, duration=0.1)
+class RigManager(object):
+    """
+    Runs crush protocols on several rigs at once, one worker thread per
+    serial port. Each rig stores its data in a subfolder named after its port
+    and a combined progress line is shown while protocols run.
+    """
 
-        writer.writerow(('Timestamp (s)', 'Position (mm)', 'Velocity (mm/s)',
-                         'Force (N)', 'Torque', 'Stage'))
-        writer.writerows(data)
+    def __init__(self, ports, silent=True):
+        names = [Path(str(port)).name for port in ports]
+        assert len(set(names)) == len(names), 'Serial ports must be unique'
+
+        # Connect concurrently as each rig resets and homes
+        self._executor = ThreadPoolExecutor(max_workers=len(ports))
+        rigs = self._executor.map(partial(connect, silent=silent), ports)
+        self.rigs = dict(zip(names, rigs))
+        self.progress = {name: (None, 0) for name in names}
+
+    def run(self, protocol, target_weight, folder=None, **kwargs):
+        """
+        Runs the protocol at target weight in grams on all rigs concurrently.
+        Data is stored in folder (current directory by default) and a dict of
+        rig name to data file path is returned.
+        Keyword arguments are passed to single_crush or multi_crush, sensor
+        readings are stored rather than Newtons unless raw=False is given.
+        """
+        if folder is None:
+            folder = Path.cwd()
+        target_force = to_force(target_weight)
+
+        futures = {}
+        for name, rig in self.rigs.items():
+            rig_folder = Path(folder).joinpath(name)
+            rig_folder.mkdir(parents=True, exist_ok=True)
+            filepath = get_filepath(protocol, target_weight, rig_folder)
+            futures[name] = self._executor.submit(
+                self._run, name, rig, protocol, target_force, filepath,
+                **kwargs)
+
+        while not all(future.done() for future in futures.values()):
+            self.show()
+            time.sleep(0.5)
+        self.show()
+        print()
+
+        return {name: future.result() for name, future in futures.items()}
+
+    def _run(self, name, rig, protocol, target_force, filepath, **kwargs):
+        def progress(stage, count):
+            self.progress[name] = (stage, count)
+
+        rig.wait(for_stop=True)  # at start height
+        kwargs.setdefault('raw', True)
+        header = RAW_HEADER if kwargs['raw'] else HEADER
+        with CrushWriter(filepath, header=header, columnar=True) as data:
+            run_protocol(protocol, target_force, rig=rig, progress=progress,
+                         sink=data, **kwargs)
+        return filepath
+
+    def show(self):
+        """
+        Prints the stage and sample count of each rig on a single line.
+        """
+        stages = ('approach', 'crush', 'target', 'release')
+        status = []
+        for name, (stage, count) in self.progress.items():
+            stage = 'waiting' if stage is None else stages[stage]
+            status.append(f'{name}: {stage} ({count} samples)')
+        print('\r' + ' | '.join(status), end='', flush=True)
+
+    def close(self):
+        for rig in self.rigs.values():
+            disconnect(rig)
+        self._executor.shutdown()
 
 
 # TODO add GUI interface and plotting
 
 # Main
 if __name__ == "__main__":
-    global start_height
-    start_height = 20  # mm
     rig = init()
 
     import sys
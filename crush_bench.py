@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+'''
+Times crush protocols against a simulated LAC-1 controller.
+
+Reports the number of samples, average sample rate and end to end duration
+of each protocol run by crush.py, without requiring the rig hardware.
+Usage: python crush_bench.py [target load in grams] [protocol ...]
+
+Written by Matt MacDonald
+For CIGITI at the Hospital for Sick Children Toronto
+'''
+
+
+import sys
+import time
+
+import crush
+from lac1 import LAC1
+from lac1_sim import SimulatedLAC1, TissueModel
+
+
+def setup(tissue=None, silent=True, **kwargs):
+    """
+    Connects to a simulated rig and positions it at the start height ready
+    for crush protocols. Keyword arguments are passed to SimulatedLAC1.
+    """
+    port = SimulatedLAC1(tissue=tissue, **kwargs)
+    rig = LAC1(port, silent=silent)
+    rig.home()
+    crush.rig = rig
+    crush.prep(rig)
+    rig.wait(for_stop=True)
+    return rig
+
+
+def benchmark(protocols=crush.PROTOCOLS, target_weight=500, tissue=None,
+              **kwargs):
+    """
+    Runs each protocol on a simulated rig at the target load in grams and
+    returns a dict of protocol name to (samples, sample rate, duration).
+    """
+    rig = setup(tissue, **kwargs)
+    target_force = crush.to_force(target_weight)
+
+    results = {}
+    for protocol in protocols:
+        start = time.perf_counter()
+        data = crush.run_protocol(protocol, target_force)
+        elapsed = time.perf_counter() - start
+        results[protocol] = crush.summarize(protocol, data, elapsed)
+
+    rig.close()
+    return results
+
+
+# Main
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    target_weight = float(args.pop(0)) if args else 500
+    protocols = args if args else crush.PROTOCOLS
+    benchmark(protocols, target_weight, tissue=TissueModel())
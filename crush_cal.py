@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+'''
+Define load cell calibrations used to convert force sensor readings.
+
+Each calibration is a linear fit of force in N to the 10 bit ADC reading of
+the load cell amplifier, recorded with the weights listed. Add a record
+here when the rig is recalibrated or a load cell is replaced, the latest
+record is the one used by crush.py.
+
+Written by Matt MacDonald
+For CIGITI at the Hospital for Sick Children Toronto
+'''
+
+
+from datetime import date
+from collections import namedtuple
+
+
+ADC_COUNTS = 1024  # 10 bit analog input
+LOAD_CELL = 'crush rig'  # only load cell used so far
+
+
+class Calibration(namedtuple('Calibration',
+                             'date slope offset load_cell points')):
+    """
+    Load cell calibration record: date recorded, slope in N per ADC count,
+    offset in N, load cell ID and the (grams, reading) points fitted.
+    """
+
+    def force(self, voltage):
+        # Converts a reading into Newtons as per the calibration curve
+        return round(self.slope * int(voltage) + self.offset, 6)
+
+    def voltage(self, force):
+        # Converts Newtons back into the nearest reading
+        return int(round((force - self.offset) / self.slope))
+
+    def table(self):
+        """
+        Returns the force for every possible reading, so that converting a
+        reading is a single lookup
+        """
+        return tuple(self.force(voltage) for voltage in range(ADC_COUNTS))
+
+    def key(self):
+        # Identifies the conversion, e.g. for cache keys
+        return f'{self.date.isoformat()} {self.slope} {self.offset}'
+
+
+CALIBRATIONS = (
+    Calibration(date(2018, 10, 24), 0.0274, -8.175, LOAD_CELL,
+                ((0, 298.7), (100, 334.2), (300, 405.9), (500, 477.5),
+                 (800, 585.1), (1000, 656.5), (1200, 728.5))),
+    # Shift of approximately 0.17 N (17.3 g) from the previous calibration
+    Calibration(date(2019, 2, 19), 0.02733, -8.3447, LOAD_CELL,
+                ((0, 305.4), (100, 341.2), (300, 413.0), (500, 484.2),
+                 (800, 592.6), (1000, 664.6), (1200, 735.6))),
+)
+
+
+def latest(load_cell=LOAD_CELL):
+    """
+    Returns the most recent calibration of the load cell.
+    """
+    return lookup(date.max, load_cell)
+
+
+def lookup(when, load_cell=LOAD_CELL):
+    """
+    Returns the calibration of the load cell in effect on a date, the
+    earliest one for dates before any calibration.
+    """
+    if hasattr(when, 'date'):
+        when = when.date()  # datetime or pandas Timestamp
+    records = sorted((cal for cal in CALIBRATIONS
+                      if cal.load_cell == load_cell), key=lambda cal: cal.date)
+    assert records, f'No calibration for load cell {load_cell}'
+    found = records[0]
+    for cal in records:
+        if cal.date <= when:
+            found = cal
+    return found
@@ -0,0 +1,484 @@
+#!/usr/bin/env python
+
+'''
+Define storage of crush data files.
+
+Written by Matt MacDonald
+For CIGITI at the Hospital for Sick Children Toronto
+'''
+
+
+import csv
+import os
+import sys
+import queue
+import threading
+from array import array
+from pathlib import Path
+from functools import lru_cache
+
+import crush_cal
+
+
+HEADER = ('Timestamp (ns)', 'Position (mm)', 'Velocity (mm/s)',
+          'Force (N)', 'Torque', 'Stage')
+# Force sensor reading in ADC counts stored in place of Newtons
+RAW_HEADER = ('Timestamp (ns)', 'Position (mm)', 'Velocity (mm/s)',
+              'Voltage', 'Torque', 'Stage')
+# Integer ns from the start of the protocol, seconds in older files
+TIMESTAMP_COLUMNS = ('Timestamp (ns)', 'Timestamp (s)')
+FOOTER = '# complete'
+ABORTED_FOOTER = '# aborted'  # closed after an exception while recording
+FSYNC_POLICIES = ('chunk', 'close', 'never')
+
+# Columnar bundles are folders of .npy files, one per column, stored with
+# these array typecodes (double for any column not listed)
+BUNDLE_SUFFIX = '.crush'
+BUNDLE_HEADER = 'header.csv'
+COLUMN_TYPES = {'Timestamp (ns)': 'q',
+                'Timestamp (s)': 'd',
+                'Position (mm)': 'f',
+                'Velocity (mm/s)': 'f',
+                'Force (N)': 'f',
+                'Voltage': 'h',
+                'Torque': 'i',
+                'Stage': 'b'}
+NPY_TYPES = {'d': 'f8', 'f': 'f4', 'q': 'i8', 'i': 'i4', 'h': 'i2',
+             'b': 'i1'}
+NPY_HEADER_LEN = 128  # fixed so the shape can be rewritten on close
+
+
+class CrushWriter(object):
+    """
+    Writes crush data to a csv file while it is recorded.
+
+    Rows appended are collected into chunks which a background thread writes
+    and flushes to disk, so memory use stays flat and everything up to the
+    last chunk survives an abort. Only the first and last rows are kept in
+    memory, so indexing supports 0 and -1 only.
+
+    fsync controls when the file is forced to disk: after every 'chunk',
+    only on 'close', or 'never'. On close a footer line with the number of
+    rows is written, files without it were not closed cleanly (see recover).
+    Leaving a with block on an exception closes with an aborted footer
+    instead, so the file is readable but not complete (see is_complete).
+
+    If columnar is True the data is also written to a columnar bundle with
+    the same name and the suffix .crush, see ColumnOutput.
+    """
+
+    def __init__(self, path, header=HEADER, chunk_size=100, fsync='chunk',
+                 columnar=False):
+        assert fsync in FSYNC_POLICIES, f'Unknown fsync policy {fsync}'
+        self.path = Path(path)
+        self._chunk_size = chunk_size
+        self._fsync = fsync
+        self._chunk = []
+        self._count = 0
+        self._first = None
+        self._last = None
+        self._error = None
+
+        self._outputs = [CsvOutput(self.path, header)]
+        if columnar:
+            bundle = self.path.with_suffix(BUNDLE_SUFFIX)
+            self._outputs.append(ColumnOutput(bundle, header))
+
+        self._chunks = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.close(aborted=exc_type is not None)
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        if self._count and index == 0:
+            return self._first
+        elif self._count and index == -1:
+            return self._last
+        raise IndexError('Only the first and last rows are kept')
+
+    def append(self, row):
+        if self._error is not None:
+            raise self._error
+        if self._first is None:
+            self._first = row
+        self._last = row
+        self._count += 1
+        self._chunk.append(row)
+        if len(self._chunk) >= self._chunk_size:
+            self.flush()
+
+    def extend(self, rows):
+        for row in rows:
+            self.append(row)
+
+    def flush(self):
+        """
+        Hands the rows collected so far to the writer thread.
+        """
+        if self._chunk:
+            self._chunks.put(self._chunk)
+            self._chunk = []
+
+    def close(self, aborted=False):
+        """
+        Writes the remaining rows and the footer, the aborted footer if
+        the recording did not finish.
+        """
+        if self._thread is None:
+            return
+        self.flush()
+        self._chunks.put(None)
+        self._thread.join()
+        self._thread = None
+
+        for output in self._outputs:
+            output.close(self._count, sync=(self._fsync != 'never'),
+                         aborted=aborted)
+
+        if self._error is not None:
+            raise self._error
+
+    def _run(self):
+        while True:
+            chunk = self._chunks.get()
+            if chunk is None:
+                break
+            try:
+                for output in self._outputs:
+                    output.write(chunk, sync=(self._fsync == 'chunk'))
+            except Exception as error:
+                self._error = error
+
+
+class SampleBuffer(object):
+    """
+    Stores crush data rows in memory as one typed array per column (see
+    COLUMN_TYPES), preallocated and grown geometrically so that appending a
+    row does not allocate. Rows can be appended and indexed like a list, as
+    tuples of the column values, and to_dataframe() returns the data as read
+    by crush_read.
+    """
+
+    def __init__(self, header=HEADER, capacity=4096):
+        self.header = tuple(header)
+        self._count = 0
+        self._capacity = capacity
+        self._columns = [array(COLUMN_TYPES.get(name, 'd'), [0]) * capacity
+                         for name in self.header]
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError('Sample index out of range')
+        return tuple(column[index] for column in self._columns)
+
+    def __iter__(self):
+        for index in range(self._count):
+            yield tuple(column[index] for column in self._columns)
+
+    def append(self, row):
+        if self._count == self._capacity:
+            self._grow()
+        index = self._count
+        for column, value in zip(self._columns, row):
+            column[index] = value
+        self._count += 1
+
+    def extend(self, rows):
+        for row in rows:
+            self.append(row)
+
+    def _grow(self):
+        for column in self._columns:
+            column.extend(column)  # doubles capacity, values are replaced
+        self._capacity *= 2
+
+    def column(self, name):
+        """
+        Returns a copy of the named column as an array.
+        """
+        return self._columns[self.header.index(name)][:self._count]
+
+    def to_dataframe(self, calibration=None):
+        """
+        Returns the data as a dataframe indexed by timestamp, see
+        to_dataframe.
+        """
+        import numpy as np
+
+        columns = {name: np.array(column[:self._count],
+                                  dtype=NPY_TYPES[column.typecode])
+                   for name, column in zip(self.header, self._columns)}
+        return to_dataframe(columns, calibration)
+
+
+class CsvOutput(object):
+    """
+    Writes rows to a csv file with a header line and a footer line on close,
+    marked as aborted if the recording did not finish.
+    """
+
+    def __init__(self, path, header):
+        self._file = open(path, 'w', newline='')
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(header)
+
+    def write(self, rows, sync=False):
+        self._writer.writerows(rows)
+        self._file.flush()
+        if sync:
+            os.fsync(self._file.fileno())
+
+    def close(self, count, sync=True, aborted=False):
+        footer = ABORTED_FOOTER if aborted else FOOTER
+        self._file.write(f'{footer}: {count} rows\n')
+        self._file.flush()
+        if sync:
+            os.fsync(self._file.fileno())
+        self._file.close()
+
+
+class ColumnOutput(object):
+    """
+    Writes rows to a columnar bundle: a folder holding the header in a csv
+    file and each column as a typed .npy file that numpy can load or memory
+    map directly. The row count in each .npy header is set on close, after
+    an abort it can be recovered from the file sizes (see read_columns).
+    Uses only the standard library so numpy is not needed while recording.
+    """
+
+    def __init__(self, path, header):
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        with open(path / BUNDLE_HEADER, 'w', newline='') as file:
+            csv.writer(file).writerow(header)
+
+        self._types = [COLUMN_TYPES.get(name, 'd') for name in header]
+        self._files = []
+        for name, typecode in zip(header, self._types):
+            file = open(path / column_filename(name), 'wb')
+            file.write(_npy_header(typecode, 0))
+            self._files.append(file)
+
+    def write(self, rows, sync=False):
+        for i, (file, typecode) in enumerate(zip(self._files, self._types)):
+            column = array(typecode, [row[i] for row in rows])
+            if sys.byteorder != 'little':
+                column.byteswap()
+            file.write(column.tobytes())
+            file.flush()
+            if sync:
+                os.fsync(file.fileno())
+
+    def close(self, count, sync=True, aborted=False):
+        # Aborted bundles hold whole rows so are closed the same
+        for file, typecode in zip(self._files, self._types):
+            file.seek(0)
+            file.write(_npy_header(typecode, count))
+            file.flush()
+            if sync:
+                os.fsync(file.fileno())
+            file.close()
+
+
+def column_filename(name):
+    """
+    Returns the .npy file name of a column, its name without units.
+    """
+    name = name.split(' (')[0].strip().lower().replace(' ', '_')
+    return f'{name}.npy'
+
+
+def _npy_header(typecode, count):
+    # Version 1.0 .npy header padded to a fixed length
+    descr = '<' + NPY_TYPES[typecode]
+    header = (f"{{'descr': '{descr}', 'fortran_order': False, "
+              f"'shape': ({count},), }}")
+    header = header.ljust(NPY_HEADER_LEN - 10 - 1) + '\n'
+    return (b'\x93NUMPY\x01\x00' +
+            (NPY_HEADER_LEN - 10).to_bytes(2, 'little') +
+            header.encode('latin1'))
+
+
+def read_columns(path, mmap=False):
+    """
+    Reads a columnar bundle and returns a dict of column name to numpy array
+    in header order. Arrays are memory mapped read only if mmap is True.
+    Bundles from aborted recordings are read up to the last complete row.
+    """
+    import numpy as np
+
+    path = Path(path)
+    with open(path / BUNDLE_HEADER, newline='') as file:
+        header = next(csv.reader(file))
+
+    columns = {}
+    for name in header:
+        file = path / column_filename(name)
+        with open(file, 'rb') as npy:
+            np.lib.format.read_magic(npy)
+            _, _, dtype = np.lib.format.read_array_header_1_0(npy)
+            offset = npy.tell()
+        count = (file.stat().st_size - offset) // dtype.itemsize
+        if mmap and count:
+            column = np.memmap(file, dtype=dtype, mode='r', offset=offset,
+                               shape=(count,))
+        else:
+            column = np.fromfile(file, dtype=dtype, count=count,
+                                 offset=offset)
+        columns[name] = column
+
+    length = min(len(column) for column in columns.values())
+    return {name: column[:length] for name, column in columns.items()}
+
+
+def to_dataframe(columns, calibration=None, upcast=True):
+    """
+    Returns crush data from a dataframe or dict of column name to array as
+    the dataframe used by crush_read, indexed by timestamp as a timedelta
+    whether stored in ns or s (see TIMESTAMP_COLUMNS). Single precision
+    columns are converted to double if upcast is True, and raw sensor
+    readings in a Voltage column are converted to a Force column with the
+    calibration, the latest by default (see crush_cal).
+    """
+    import numpy as np
+    import pandas as pd
+
+    data = pd.DataFrame(columns, copy=False)
+    if upcast:
+        data = data.astype({name: np.float64 for name in data.columns
+                            if data[name].dtype == np.float32})
+    if 'Voltage' in data.columns and 'Force (N)' not in data.columns:
+        if calibration is None:
+            calibration = crush_cal.latest()
+        voltage = data['Voltage'].to_numpy().astype(np.intp)
+        data.insert(data.columns.get_loc('Voltage'), 'Force (N)',
+                    force_table(calibration)[voltage])
+
+    # Index named as in older files whichever unit timestamps are stored in
+    if 'Timestamp (ns)' in data.columns:
+        timestamps = data.pop('Timestamp (ns)').astype(np.int64)
+        timestamps = pd.to_timedelta(timestamps.to_numpy(), unit='ns')
+    else:
+        timestamps = pd.to_timedelta(data.pop('Timestamp (s)').to_numpy(),
+                                     unit='s')
+    data.index = pd.Index(timestamps, name='Timestamp (s)')
+    return data
+
+
+@lru_cache()
+def force_table(calibration):
+    """
+    Returns the force at every sensor reading of a calibration as a numpy
+    array.
+    """
+    import numpy as np
+
+    return np.array(calibration.table())
+
+
+def convert(path, remove=False):
+    """
+    Converts a csv crush data file to a columnar bundle alongside it and
+    returns the bundle path. Optionally removes the csv file afterwards.
+    """
+    path = Path(path)
+    bundle = path.with_suffix(BUNDLE_SUFFIX)
+    with open(path, newline='') as file:
+        reader = csv.reader(file)
+        header = next(reader)
+        integer = [COLUMN_TYPES.get(name, 'd') in 'qihb' for name in header]
+
+        output = ColumnOutput(bundle, header)
+        count = 0
+        rows = []
+        for line in reader:
+            if not line or line[0].startswith('#'):
+                continue
+            if len(line) < len(header) or not line[-1]:
+                break  # partial last row of an aborted recording
+            rows.append([_to_int(value) if is_int else float(value)
+                         for is_int, value in zip(integer, line)])
+            if len(rows) >= 10000:
+                output.write(rows)
+                count += len(rows)
+                rows = []
+        output.write(rows)
+        output.close(count + len(rows))
+
+    if remove:
+        path.unlink()
+    return bundle
+
+
+def convert_folder(root, pattern='*.csv', remove=False):
+    """
+    Converts every csv crush data file matching pattern in root and its sub
+    folders that does not have a columnar bundle yet. Returns the bundles.
+    """
+    bundles = []
+    for path in sorted(Path(root).rglob(pattern)):
+        if (path.parent.suffix == BUNDLE_SUFFIX or
+                path.with_suffix(BUNDLE_SUFFIX).exists()):
+            continue
+        with open(path, newline='') as file:
+            header = next(csv.reader(file), [])
+        if header[:1] not in [[name] for name in TIMESTAMP_COLUMNS]:
+            continue  # not crush data, e.g. the study outline
+        bundles.append(convert(path, remove))
+    return bundles
+
+
+def _to_int(value):
+    # Parses an integer column value, written as a float by older versions
+    try:
+        return int(value)
+    except ValueError:
+        return int(float(value))
+
+
+def is_complete(path):
+    """
+    Returns True if the csv file ends with the footer written on close.
+    """
+    with open(path, 'rb') as file:
+        file.seek(0, os.SEEK_END)
+        file.seek(max(file.tell() - 64, 0))
+        lines = file.read().decode('utf-8', 'replace').splitlines()
+    return bool(lines) and lines[-1].startswith(FOOTER)
+
+
+def recover(path):
+    """
+    Makes a csv file from an aborted recording readable by removing any
+    partially written last row or aborted footer and adding the footer.
+    Returns the number of rows recovered.
+    """
+    if is_complete(path):
+        with open(path, 'r', newline='') as file:
+            return len(file.readlines()) - 2  # header and footer
+
+    with open(path, 'r+', newline='') as file:
+        lines = file.readlines()
+        if lines and not lines[-1].endswith('\n'):
+            lines = lines[:-1]
+        if len(lines) > 1 and lines[-1].startswith(ABORTED_FOOTER):
+            lines = lines[:-1]
+        count = max(len(lines) - 1, 0)
+        file.seek(0)
+        file.writelines(lines)
+        file.write(f'{FOOTER}: {count} rows (recovered)\n')
+        file.truncate()
+    return count
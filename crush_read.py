@@ -20,15 +20,53 @@ import platform
 from pathlib import Path
 import glob
 import re
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 from pdb import set_trace
 
+from crush_io import read_columns, to_dataframe
+import crush_cal
+
 
 # CONSTANTS
 
 PATH = Path('/Users/mattmacdonald/Data/RAWDATA_CRUSH_PAPER2/')
 PIN_DIAM = 5.0  # mm
 
+# Low pass butterworth filter used to smooth force, designed once as second
+# order sections and applied forward and backward (see smooth_force)
+FILTER_ORDER = 3
+FILTER_CUTOFF = 0.2  # fraction of nyquist frequency
+FILTER_SOS = signal.butter(FILTER_ORDER, FILTER_CUTOFF, output='sos')
+FILTER_PADLEN = 3 * (FILTER_ORDER + 1)  # same as filtfilt with (b, a)
+
+# Columns added to each transient by modify(), force is always smoothed
+DERIVED_COLUMNS = ('Raw Force (N)',
+                   'Pressure (kPa)',
+                   'Stress (MPa)',
+                   'Strain',
+                   'Stiffness (MPa)')
+
+# Version of each processing step, increment when a step is changed so that
+# cached results depending on it are recalculated (see cached)
+# Features added by calculate() are versioned where registered (see feature)
+STEP_VERSIONS = {'read_transient': 1,
+                 'tare_force': 1,
+                 'smooth_force': 1,
+                 'add_pressure': 1,
+                 'add_stress': 1,
+                 'add_strain': 1,
+                 'add_stiffness': 2,
+                 'calculate': 1}
+MODIFY_STEPS = ('read_transient', 'tare_force', 'smooth_force',
+                'add_pressure', 'add_stress', 'add_strain', 'add_stiffness')
+
+# Number of transients read by lazy handles kept in memory (see Transient)
+LAZY_CACHE_SIZE = 32
+
 
 # IMPORT FUNCTIONS
 
@@ -134,13 +172,94 @@ def study_targets(root_folder=None):
     return targets
 
 
-def study_data(study):
+def study_files(study):
+    """
+    Finds all crush data files as per study outline dataframe
+    Returns a list of (Test ID, file path, protocol, load) tuples
+    Columnar .crush bundles are listed instead of csv files with the same name
+    """
+    crush_pattern = re.compile(r"(?P<protocol>\w+)-"
+                               r"(?P<load>\d+.?\d*)g"
+                               r"-?\d*\.(csv|crush)$")
+    found = []
+    for test in study.index:
+        path = PATH / study.loc[test, 'Folder Name']
+        files = [path / file for file in sorted(os.listdir(path))]
+
+        for file in files:
+            crush_match = crush_pattern.match(file.name)
+            if not crush_match:
+                continue
+            if (file.suffix == '.csv' and
+                    file.with_suffix('.crush') in files):
+                continue  # read columnar copy instead
+            found.append((test, file,
+                          crush_match.group('protocol').upper(),
+                          int(float(crush_match.group('load')))))
+    return found
+
+
+def study_data(study, workers=None, processes=False, lazy=False,
+               mmap=False):
     """
     Reads all crush data as per study outline dataframe
-    Loops over each Test ID and reads subfolder
-    Data csv files must be unchanged from the output from crush.py
+    Finds the files in each Test ID subfolder, then reads them in parallel
+    with a pool of workers, threads by default or processes if requested
+    If lazy is True no files are read, Data holds Transient handles that
+    read the transient the first time it is used instead
+    Handles are read only, the functions that change transients (modify,
+    smooth_force, add_stress etc.) return dataframes in their place, e.g.
+    crushes['Data'] = crushes['Data'].apply(add_pressure)
+    Columnar bundles are memory mapped if mmap is True, see read_transient
+    Sensor readings are converted with the calibration in effect on the
+    procedure date of each Test ID, see crush_cal
+    Data files must be unchanged from the output from crush.py
     Returns dataframe with each crush as a separate row
     """
+    files = study_files(study)
+    calibrations = study_calibrations(study, [test for test, _, _, _ in files])
+    if lazy:
+        transients = [Transient(file, mmap, calibration)
+                      for (_, file, _, _), calibration
+                      in zip(files, calibrations)]
+    else:
+        transients = read_transients([file for _, file, _, _ in files],
+                                     workers, processes, mmap, calibrations)
+    crushes = study_table(study, files)
+    crushes['Data'] = object_series(transients, crushes.index)
+    return crushes
+
+
+def read_transients(files, workers=None, processes=False, mmap=False,
+                    calibrations=None):
+    """
+    Reads crush data files in parallel with a pool of workers, threads by
+    default or processes if requested, and returns a list of transients
+    Optionally with a list of the calibration to use for each file
+    """
+    files = list(files)
+    if calibrations is None:
+        calibrations = [None] * len(files)
+    if processes:
+        pool = ProcessPoolExecutor(workers)
+    else:
+        pool = ThreadPoolExecutor(workers)
+    with pool:
+        return list(pool.map(read_transient, files, [mmap] * len(files),
+                             calibrations))
+
+
+def study_calibrations(study, tests):
+    # Returns the load cell calibration on the procedure date of each test
+    dates = study.loc[list(tests), 'Procedure Date']
+    return [crush_cal.lookup(when) for when in dates]
+
+
+def study_table(study, files):
+    """
+    Returns the crushes dataframe for files listed by study_files, with
+    meta data from the study outline dataframe and no Data
+    """
 
     features = ['Test ID',
                 'Patient',
@@ -150,45 +269,33 @@ def study_data(study):
                 'Age (years)',
                 'Load (g)',
                 'Summary',
+                'File',
+                'Calibration',
                 'Data']
 
-    crushes = pd.DataFrame(columns=features)
-    crush_pattern = re.compile(r"(?P<protocol>\w+)-"
-                               r"(?P<load>\d+.?\d*)g"
-                               r"-?\d*.csv")
-    for test in study.index:
-        path = PATH / study.loc[test, 'Folder Name']
-        files = [path / file for file in os.listdir(path)]
-
-        # Read all patient crush data and add to dataframe
-        for file in files:
-            crush_match = crush_pattern.match(file.name)
-            if not crush_match:
-                continue
-
-            # Read and set index to timestamp
-            data = pd.read_csv(file)
-            data['Timestamp (s)'] = pd.to_timedelta(data['Timestamp (s)'],
-                                                    unit='s')
-            data = data.set_index('Timestamp (s)')
-
-            # Parse meta data and append to end of crushes
-            crush_dict = {
-                'Test ID': test,
-                'Patient': study.loc[test, 'Patient Code'].upper(),
-                'Protocol': crush_match.group('protocol').upper(),
-                'Tissue': study.loc[test, 'Classification'].upper(),
-                'Gender': study.loc[test, 'Gender'].upper(),
-                'Age (years)': int((study.loc[test, 'Procedure Date'] -
-                                   study.loc[test, 'DOB']).days) / 365,
-                'Load (g)': int(float(crush_match.group('load'))),
-                'Data': data}
-            crush_dict['Summary'] = "Patient {} ({}), {} crush at {}g".format(
-                                    crush_dict['Patient'],
-                                    crush_dict['Tissue'],
-                                    crush_dict['Protocol'],
-                                    crush_dict['Load (g)'])
-            crushes = crushes.append(crush_dict, ignore_index=True)
+    # Build meta data for all crushes at once
+    patients = study['Patient Code'].str.upper()
+    tissues = study['Classification'].str.upper()
+    genders = study['Gender'].str.upper()
+    ages = (study['Procedure Date'] - study['DOB']).dt.days / 365
+    tests = [test for test, _, _, _ in files]
+    crushes = pd.DataFrame({
+        'Test ID': tests,
+        'Patient': patients[tests].values,
+        'Protocol': [protocol for _, _, protocol, _ in files],
+        'Tissue': tissues[tests].values,
+        'Gender': genders[tests].values,
+        'Age (years)': ages[tests].values,
+        'Load (g)': [load for _, _, _, load in files]},
+        columns=features)
+    crushes['Summary'] = ("Patient " + crushes['Patient'] +
+                          " (" + crushes['Tissue'] + "), " +
+                          crushes['Protocol'] + " crush at " +
+                          crushes['Load (g)'].astype(str) + "g")
+    crushes['File'] = [str(file) for _, file, _, _ in files]
+    crushes['Calibration'] = [cal.key() for cal
+                              in study_calibrations(study, tests)]
+    crushes['Data'] = None
 
     types = {'Age (years)': np.float64,
              'Load (g)': np.int64}
@@ -197,10 +304,215 @@ def study_data(study):
     return crushes
 
 
+def read_transient(file, mmap=False, calibration=None):
+    """
+    Reads a crush data file, either csv or a columnar .crush bundle, and
+    returns a dataframe indexed by timestamp.
+    Columns stored in single precision are converted to double to match csv
+    data unless mmap is True, in which case they are memory mapped as is.
+    Files with raw sensor readings in a Voltage column get a Force column
+    converted with the calibration, the latest by default.
+    """
+    file = Path(file)
+    if file.suffix == '.crush':
+        return to_dataframe(read_columns(file, mmap=mmap), calibration,
+                            upcast=not mmap)
+
+    # Skip the footer and any partial last row of a recording that was not
+    # closed cleanly
+    data = pd.read_csv(file, comment='#').dropna()
+    return to_dataframe(data, calibration)
+
+
+class Transient(object):
+    """
+    Handle to a crush data file that reads the transient on first use
+    Attribute and item access are passed on to the transient dataframe, so
+    a handle can be used in place of it by the analysis functions
+    Only the LAZY_CACHE_SIZE most recently used transients are kept in
+    memory, others are read again when next used
+    """
+
+    _loaded = OrderedDict()
+    _lock = threading.Lock()
+
+    def __init__(self, file, mmap=False, calibration=None):
+        self.file = Path(file)
+        self.mmap = mmap
+        self.calibration = calibration
+
+    def __repr__(self):
+        return f"Transient('{self.file}')"
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.load(), name)
+
+    def __getitem__(self, key):
+        return self.load()[key]
+
+    def __len__(self):
+        return len(self.load())
+
+    def load(self):
+        """
+        Returns the transient dataframe, reading the file if not in memory
+        """
+        key = (self.file, self.mmap, self.calibration)
+        with Transient._lock:
+            if key in Transient._loaded:
+                Transient._loaded.move_to_end(key)
+                return Transient._loaded[key]
+
+        data = read_transient(self.file, self.mmap, self.calibration)
+        with Transient._lock:
+            Transient._loaded[key] = data
+            while len(Transient._loaded) > LAZY_CACHE_SIZE:
+                Transient._loaded.popitem(last=False)
+        return data
+
+
+def transient(crush):
+    """
+    Returns the transient dataframe of a crush, a copy if it is read from a
+    Transient handle so that modifying it leaves the cached transient as is
+    """
+    if isinstance(crush, Transient):
+        return crush.load().copy()
+    return crush
+
+
+def object_series(items, index):
+    """
+    Returns a series holding each item as is, without numpy looking inside
+    transient dataframes or reading Transient handles
+    """
+    values = np.empty(len(items), dtype=object)
+    for i, item in enumerate(items):
+        values[i] = item
+    return pd.Series(values, index=index, dtype=object)
+
+
+_file_hashes = {}
+
+
+def file_parts(file):
+    # Returns the files making up a crush data file or .crush bundle
+    file = Path(file)
+    return sorted(file.iterdir()) if file.is_dir() else [file]
+
+
+def file_stat(file):
+    """
+    Returns the total size and latest modification time in ns of a crush
+    data file or .crush bundle
+    """
+    stats = [part.stat() for part in file_parts(file)]
+    return (sum(stat.st_size for stat in stats),
+            max(stat.st_mtime_ns for stat in stats))
+
+
+def file_hash(file):
+    """
+    Returns a hash of the contents of a crush data file or .crush bundle
+    Hashes are remembered while the file size and modification time match
+    """
+    file = Path(file)
+    parts = file_parts(file)
+    stamp = tuple((part.name, part.stat().st_size, part.stat().st_mtime_ns)
+                  for part in parts)
+    if _file_hashes.get(file, (None,))[0] != stamp:
+        digest = hashlib.sha1()
+        for part in parts:
+            digest.update(part.name.encode())
+            with open(part, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(block)
+        _file_hashes[file] = (stamp, digest.hexdigest())
+    return _file_hashes[file][1]
+
+
+def cache_key(file, calibration, steps):
+    """
+    Returns the cache key of a result derived from file, read with the
+    calibration key (see study_table), by the given steps
+    """
+    versions = step_versions(steps)
+    key = f'{file_hash(file)}:{calibration}:{versions}'
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def step_versions(steps):
+    # Returns the versions of the given steps and features as a string
+    versions = {**STEP_VERSIONS,
+                **{name: version for name, (_, version) in FEATURES.items()}}
+    return ','.join(f'{step}={versions[step]}' for step in steps)
+
+
+def cached(cache, name, file, calibration, steps, func, *args):
+    """
+    Returns func(*args), read from the cache folder if it was stored before
+    for the same file contents, calibration and step versions, otherwise
+    calculated and stored. Nothing is cached if cache is None.
+    """
+    if cache is None:
+        return func(*args)
+    path = cache_path(cache, name, file, calibration, steps)
+    if path.exists():
+        return pd.read_pickle(path)
+    result = func(*args)
+    cache_store(path, result)
+    return result
+
+
+def cache_path(cache, name, file, calibration, steps):
+    # Returns the path of a result in the cache folder
+    return Path(cache) / name / f'{cache_key(file, calibration, steps)}.pkl'
+
+
+def cache_name(name, columns=DERIVED_COLUMNS, dtype=np.float64):
+    # Returns the cache folder of results for modify() options other than
+    # the defaults, so they are not mixed up
+    if tuple(columns) != DERIVED_COLUMNS or dtype != np.float64:
+        options = f'{list(columns)},{np.dtype(dtype).name}'
+        name += '-' + hashlib.sha1(options.encode()).hexdigest()[:8]
+    return name
+
+
+def cache_store(path, result):
+    # Stores a result in the cache
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp = path.with_suffix('.tmp')
+    pd.to_pickle(result, temp)
+    temp.replace(path)  # so an interrupted write is never read
+
+
+def clear_cache(cache, crushes=None):
+    """
+    Removes cached results from the cache folder
+    If crushes is given only results still valid for them are kept
+    Returns the number of results removed
+    """
+    keep = set()
+    if crushes is not None:
+        for file, calibration in zip(crushes['File'],
+                                     crushes['Calibration']):
+            keep.add(cache_key(file, calibration, MODIFY_STEPS))
+            keep.add(cache_key(file, calibration, calculate_steps()))
+    removed = 0
+    for path in Path(cache).glob('*/*.pkl'):
+        if path.stem not in keep:
+            path.unlink()
+            removed += 1
+    return removed
+
+
 # ANALYSIS FUNCTIONS
 
 def sample_period(crush):
-    return pd.Timedelta(np.mean(crush.index[1:] - crush.index[:-1]))
+    # Mean time between samples
+    return (crush.index[-1] - crush.index[0]) / (len(crush) - 1)
 
 
 def sample_rate(crush):
@@ -212,17 +524,40 @@ def total_time(crush):
     return crush.index[-1]
 
 
-def stage_times(crush):
+def stage_index(crush):
+    """
+    Returns the position of the first row of each run of a stage and the
+    stage of each run, found in a single pass over the Stage column
+    Functions of the stages take this as index so that it can be found once
+    and reused, they find it themselves if not given
+    """
+    stages = crush['Stage'].to_numpy()
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(stages)) + 1))
+    return starts, stages[starts]
+
+
+def stage_start(crush, stage, index=None):
+    # Returns the position of the first row of stage, 0 if not found
+    if index is None:
+        index = stage_index(crush)
+    starts, stages = index
+    found = starts[stages == stage]
+    return found[0] if len(found) else 0
+
+
+def stage_times(crush, index=None):
     # Return time of transition for each stage
     # 0 for approach, 1 for crush, 2 for target, 3 for release
+    if index is None:
+        index = stage_index(crush)
     times = [pd.Timedelta(0)]
     for stage in range(1, 4):
-        times.append((crush['Stage'] == stage).idxmax())
+        times.append(crush.index[stage_start(crush, stage, index)])
     return tuple(times)
 
 
-def stage_durations(crush):
-    times = [*stage_times(crush), total_time(crush)]
+def stage_durations(crush, index=None):
+    times = [*stage_times(crush, index), total_time(crush)]
     durations = []
     for transitions in zip(times[1:], times[:-1]):
         delta = (transitions[0] - transitions[1]).total_seconds()
@@ -230,70 +565,77 @@ def stage_durations(crush):
     return tuple(durations)
 
 
-def stage_repetition(crush):
+def stage_repetition(crush, index=None):
     # Returns the start of stage 0 again if any
-    after = release_time(crush)
-    rep = (crush.loc[after:, 'Stage'] == 0).idxmax()
-    if rep == after:
+    if index is None:
+        index = stage_index(crush)
+    starts, stages = index
+    after = stage_start(crush, 3, index)
+    reps = starts[(stages == 0) & (starts > after)]
+    if crush['Stage'].iat[after] == 0 or not len(reps):
         return None
-    return rep
+    return crush.index[reps[0]]
 
 
-def contact_time(crush):
-    return stage_times(crush)[1]
+def contact_time(crush, index=None):
+    return stage_times(crush, index)[1]
 
 
-def contact_duration(crush):
-    durations = stage_durations(crush)
+def contact_duration(crush, index=None):
+    durations = stage_durations(crush, index)
     return durations[1] + durations[2]
 
 
-def contact_position(crush):
-    return crush.loc[contact_time(crush), 'Position (mm)']
+def contact_position(crush, index=None):
+    return crush.loc[contact_time(crush, index), 'Position (mm)']
 
 
-def contact_force(crush):
-    return crush.loc[contact_time(crush), 'Force (N)']
+def contact_force(crush, index=None):
+    return crush.loc[contact_time(crush, index), 'Force (N)']
 
 
-def approach_duration(crush):
-    return stage_durations(crush)[0]
+def approach_duration(crush, index=None):
+    return stage_durations(crush, index)[0]
 
 
-def movement_duration(crush):
-    durations = stage_durations(crush)
+def movement_duration(crush, index=None):
+    durations = stage_durations(crush, index)
     return durations[0] + durations[1]
 
 
-def crush_duration(crush):
-    return stage_durations(crush)[1]
+def crush_duration(crush, index=None):
+    return stage_durations(crush, index)[1]
 
 
-def target_time(crush):
-    return stage_times(crush)[2]
+def target_time(crush, index=None):
+    return stage_times(crush, index)[2]
 
 
-def target_duration(crush):
-    return stage_durations(crush)[2]
+def target_duration(crush, index=None):
+    return stage_durations(crush, index)[2]
 
 
-def target_position(crush):
-    return crush.loc[target_time(crush), 'Position (mm)']
+def target_position(crush, index=None):
+    return crush.loc[target_time(crush, index), 'Position (mm)']
 
 
-def target_force(crush):
-    return crush.loc[target_time(crush), 'Force (N)']
+def target_force(crush, index=None):
+    return crush.loc[target_time(crush, index), 'Force (N)']
 
 
-def target_relaxation(crush):
-    return target_force(crush) - release_force(crush)
+def target_relaxation(crush, index=None):
+    if index is None:
+        index = stage_index(crush)
+    return target_force(crush, index) - release_force(crush, index)
 
 
-def target_movement(crush):
-    return release_position(crush) - target_position(crush)
+def target_movement(crush, index=None):
+    if index is None:
+        index = stage_index(crush)
+    return release_position(crush, index) - target_position(crush, index)
 
 
-def target_error(crush, load):
+def target_error(crush, load, index=None):
 
     def to_force(weight):
         return 9.81 * weight / 1000
@@ -301,32 +643,34 @@ def target_error(crush, load):
     if isinstance(load, str) and (load[-1] == 'g'):
         load = load[:-1]
     set_force = to_force(float(load))
-    return target_force(crush) - set_force
+    return target_force(crush, index) - set_force
 
 
-def release_time(crush):
-    return stage_times(crush)[3]
+def release_time(crush, index=None):
+    return stage_times(crush, index)[3]
 
 
-def release_duration(crush):
-    return stage_durations(crush)[3]
+def release_duration(crush, index=None):
+    return stage_durations(crush, index)[3]
 
 
-def release_position(crush):
-    return crush.loc[release_time(crush), 'Position (mm)']
+def release_position(crush, index=None):
+    return crush.loc[release_time(crush, index), 'Position (mm)']
 
 
-def release_force(crush):
-    return crush.loc[release_time(crush), 'Force (N)']
+def release_force(crush, index=None):
+    return crush.loc[release_time(crush, index), 'Force (N)']
 
 
-def crush_distance(crush):
-    return target_position(crush) - contact_position(crush)
+def crush_distance(crush, index=None):
+    if index is None:
+        index = stage_index(crush)
+    return target_position(crush, index) - contact_position(crush, index)
 
 
 # TODO refine this definition to be zero just before contact
-def hanging_force(crush):
-    hanging_mask = crush.index < contact_time(crush)
+def hanging_force(crush, index=None):
+    hanging_mask = crush.index < contact_time(crush, index)
     if hanging_mask.sum() == 0:
         hanging_mask[0] = True  # default to first index
     return crush['Force (N)'][hanging_mask].mean()
@@ -336,27 +680,96 @@ def smooth_force(crush):
     # Calculate force with a low pass butterworth filter
     # Intent is to smooth out noisy force sensor readings
     # Raw readings stored for future reference
+    return smooth_forces([crush])[0]
 
-    force = crush['Force (N)']
-    if 'Raw Force (N)' not in crush.columns:
-        crush['Raw Force (N)'] = force.copy()
-
-    # Split before and after the release stage to avoid artifacts
-    rel = release_time(crush)
-    pre = force.index < rel
-    post = force.index >= rel
-
-    # Filter on force data
-    N = 3  # Filter order
-    Wn = 0.2  # Cutoff frequency
-    B, A = signal.butter(N, Wn, output='ba')
-    crush.loc[pre, 'Force (N)'] = signal.filtfilt(B, A, force[pre].values)
-    crush.loc[post, 'Force (N)'] = signal.filtfilt(B, A, force[post].values)
-    return crush
+
+def smooth_forces(transients, workers=None, chunk_size=64):
+    """
+    Smooths the force of many crush transients at once, see smooth_force
+    Force is split before and after the release stage to avoid artifacts,
+    the segments of all transients are sorted by length and filtered in
+    chunks, across a pool of worker threads if workers is given
+    Returns the transients, modified in place, Transient handles are
+    replaced by dataframes
+    """
+    transients = [transient(crush) for crush in transients]
+    segments = []
+    for crush in transients:
+        if 'Raw Force (N)' not in crush.columns:
+            crush['Raw Force (N)'] = crush['Force (N)'].copy()
+        force = crush['Force (N)'].to_numpy()
+        rel = stage_start(crush, 3)
+        segments += [force[:rel], force[rel:]]
+
+    segments = filtfilt_segments(segments, workers, chunk_size)
+    for i, crush in enumerate(transients):
+        crush['Force (N)'] = np.concatenate(segments[2 * i:2 * i + 2])
+    return transients
+
+
+def filtfilt_segments(segments, workers=None, chunk_size=64):
+    """
+    Filters a list of 1D arrays with filtfilt_batch and returns them
+    Non empty arrays are sorted by length and filtered in chunks of similar
+    length, across a pool of worker threads if workers is given
+    """
+    segments = list(segments)
+    order = sorted((i for i, x in enumerate(segments) if len(x)),
+                   key=lambda i: len(segments[i]))
+    chunks = [order[i:i + chunk_size]
+              for i in range(0, len(order), chunk_size)]
+    batches = [[segments[i] for i in chunk] for chunk in chunks]
+    if workers:
+        with ThreadPoolExecutor(workers) as pool:
+            results = list(pool.map(filtfilt_batch, batches))
+    else:
+        results = map(filtfilt_batch, batches)
+    for chunk, filtered in zip(chunks, results):
+        for i, x in zip(chunk, filtered):
+            segments[i] = x
+    return segments
+
+
+def filtfilt_batch(segments, sos=FILTER_SOS, padlen=FILTER_PADLEN):
+    """
+    Filters each of a list of 1D arrays forward and backward, the same as
+    signal.sosfiltfilt with odd padding, in two calls for all arrays
+    Arrays are padded and packed left aligned into rows of a 2D array,
+    each row is reversed within its own length between passes
+    """
+    if not segments:
+        return []
+    lengths = np.array([len(x) for x in segments])
+    if lengths.min() <= padlen:
+        raise ValueError(f"Segments must be longer than padlen {padlen}")
+
+    # Odd extension at both ends as in signal.filtfilt
+    ext_lengths = lengths + 2 * padlen
+    packed = np.zeros((len(segments), ext_lengths.max()))
+    for row, x in zip(packed, segments):
+        x = np.asarray(x, dtype=np.float64)
+        row[:len(x) + 2 * padlen] = np.concatenate(
+            (2 * x[0] - x[padlen:0:-1], x,
+             2 * x[-1] - x[-2:-(padlen + 2):-1]))
+
+    # Index reversing each row within its length, -1 beyond it
+    reverse = ext_lengths[:, None] - 1 - np.arange(packed.shape[1])
+    rows = np.arange(len(segments))[:, None]
+
+    def flip(y):
+        return np.where(reverse >= 0, y[rows, np.maximum(reverse, 0)], 0.0)
+
+    zi = signal.sosfilt_zi(sos)[:, None, :]
+    y, _ = signal.sosfilt(sos, packed, axis=1, zi=zi * packed[None, :, :1])
+    y = flip(y)
+    y, _ = signal.sosfilt(sos, y, axis=1, zi=zi * y[None, :, :1])
+    y = flip(y)
+    return [row[padlen:padlen + n] for row, n in zip(y, lengths)]
 
 
 def add_pressure(crush):
     # Calculate pressure applied (same as stress)
+    crush = transient(crush)
     pin_area = np.pi * (PIN_DIAM / 2) ** 2
     crush['Pressure (kPa)'] = 1000 * crush['Force (N)'] / pin_area
     return crush
@@ -364,6 +777,7 @@ def add_pressure(crush):
 
 def add_stress(crush):
     # Calculate stress
+    crush = transient(crush)
     pin_area = np.pi * (PIN_DIAM / 2) ** 2
     crush['Stress (MPa)'] = crush['Force (N)'] / pin_area
     no_contact_mask = (crush['Stage'] == 0) | (crush['Stage'] == 3)
@@ -373,6 +787,7 @@ def add_stress(crush):
 
 def add_strain(crush):
     # Calculate strain (compressive)
+    crush = transient(crush)
     thickness = abs(contact_position(crush))
     abs_pos = crush['Position (mm)'].abs()
     strain = (thickness - abs_pos) / thickness
@@ -381,40 +796,65 @@ def add_strain(crush):
     return crush
 
 
-def add_stiffness(crush, n_pieces=10):
+def add_stiffness(crush, n_pieces=10, sliding=False):
     # Calculate the stiffness based on the piecewise slope of the stress
     # strain curve using the range of sample points before each time point.
     # The range is calculated based on the number of sample points divided
     # up into the number of pieces
+    # If sliding the slope is calculated at every sample point instead of
+    # only at the end of each piece
 
-    def slope(x, y):
-        x = np.stack([x, np.ones(len(x))], axis=1)
-        try:
-            line = np.linalg.lstsq(x, y)
-        except:
-            set_trace()
-        return line[0][0]
+    crush = transient(crush)
+    crush['Stiffness (MPa)'] = stiffness_values(
+        crush['Stage'].values, crush['Strain'].values,
+        crush['Stress (MPa)'].values, n_pieces, sliding)
+    return crush
 
-    crush['Stiffness (MPa)'] = np.nan
-    mask = crush['Stage'] == 1  # crush
-    strain = crush.loc[mask, 'Strain'].values
-    stress = crush.loc[mask, 'Stress (MPa)'].values
+
+def stiffness_values(stage, strain, stress, n_pieces=10, sliding=False,
+                     out=None):
+    """
+    Returns the stiffness at each sample from arrays of stage, strain and
+    stress as described in add_stiffness, nan where not calculated
+    Optionally written into an existing array out
+    """
+    if out is None:
+        out = np.empty(len(stage))
+    out[:] = np.nan
+    mask = stage == 1  # crush
+    strain = strain[mask]
+    stress = stress[mask]
     N = len(strain)
     if N // n_pieces < 1:
-        return crush  # no valid stiffness
-    indices = range(0, N, N // n_pieces)
-    index_ranges = [(i[1], slice(i[0], i[1], 1))
-                    for i in zip(indices[:-1], indices[1:])]
+        return out  # no valid stiffness
+    step = N // n_pieces
+    if sliding:
+        ends = np.arange(step, N)
+    else:
+        ends = np.arange(step, N, step)
 
     stiff = np.ones(N) * np.nan
-    for idx, rng in index_ranges:
-        stiffness = slope(strain[rng], stress[rng])
-        if stiffness < 0:
-            continue  # leave as nan
-        stiff[idx] = stiffness
+    stiffness = window_slopes(strain, stress, ends - step, ends)
+    stiff[ends] = np.where(stiffness < 0, np.nan, stiffness)  # leave as nan
+    out[mask] = stiff
+    return out
 
-    crush.loc[mask, 'Stiffness (MPa)'] = stiff
-    return crush
+
+def window_slopes(x, y, starts, ends):
+    """
+    Returns the least squares slope of y against x over each window of
+    samples from starts to ends (exclusive), from cumulative sums of x, y,
+    xy and x squared so every window takes constant time
+    Windows where x does not vary have a slope of nan
+    """
+    x = x - x.mean()  # centred to limit round off in the sums
+    y = y - y.mean()
+    sums = [np.concatenate(([0], np.cumsum(v))) for v in (x, y, x * y, x * x)]
+    Sx, Sy, Sxy, Sxx = [v[ends] - v[starts] for v in sums]
+    n = ends - starts
+    with np.errstate(divide='ignore', invalid='ignore'):
+        var = n * Sxx - Sx ** 2
+        return np.where(var > 0, (n * Sxy - Sx * Sy) / var, np.nan)
 
 
 def add_stiffness_fit(crush, order=3, exponential=True, percentiles=False):
@@ -424,6 +864,7 @@ def add_stiffness_fit(crush, order=3, exponential=True, percentiles=False):
     Only calculates crush stage with NaNs elsewhere
     Optionally can return calculated values at percentiles of strain
     """
+    crush = transient(crush)
     crush['Fit Stress (MPa)'] = np.nan
     crush['Stiffness (MPa)'] = np.nan
 
@@ -462,10 +903,87 @@ def add_stiffness_fit(crush, order=3, exponential=True, percentiles=False):
     return crush
 
 
+def fit_stiffness(crushes, order=3, exponential=True):
+    """
+    Fits stress vs strain of every crush transient as in add_stiffness_fit,
+    adding Fit Stress (MPa) and Stiffness (MPa) to each transient
+    The least squares problems of all crushes are solved together from
+    their normal equations, with columns scaled as in np.polyfit
+    Returns a table of polynomial coefficients for each crush, highest
+    power first, and a table of fit stress and stiffness at 0 to 100% strain
+    Crushes without enough crush stage points, or with non positive stress
+    if exponential, get NaN coefficients
+    Transient handles from a lazy study_data() are replaced by dataframes
+    """
+    powers = np.arange(order, -1, -1)
+    transients = [transient(crush) for crush in crushes['Data']]
+    masks, xs, ys = [], [], []
+    for crush in transients:
+        mask = (crush['Stage'] == 1).to_numpy()  # crush
+        x = crush['Strain'].to_numpy(dtype=np.float64)[mask]
+        y = crush['Stress (MPa)'].to_numpy(dtype=np.float64)[mask]
+        if exponential:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                y = np.log(y)
+        masks.append(mask)
+        xs.append(x)
+        ys.append(y)
+    valid = np.array([len(x) > order and np.isfinite(y).all()
+                      for x, y in zip(xs, ys)], dtype=bool)
+
+    # Sum the normal equations of each crush from its Vandermonde rows
+    coef = np.full((len(xs), order + 1), np.nan)
+    if valid.any():
+        lengths = np.array([len(x) for x in xs])[valid]
+        starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        x = np.concatenate([x for x, ok in zip(xs, valid) if ok])
+        y = np.concatenate([y for y, ok in zip(ys, valid) if ok])
+        V = x[:, None] ** powers
+        A = np.add.reduceat(V[:, :, None] * V[:, None, :], starts, axis=0)
+        b = np.add.reduceat(V * y[:, None], starts, axis=0)
+        scale = np.sqrt(np.einsum('kii->ki', A))
+        scale[scale == 0] = 1
+        A = A / (scale[:, :, None] * scale[:, None, :])
+        b = b / scale
+        solved = np.linalg.pinv(A, hermitian=True) @ b[:, :, None]
+        coef[valid] = solved[:, :, 0] / scale
+
+    def evaluate(coef, x):
+        # Returns fit stress and stiffness at x for each row of coef
+        f = (x[:, None] ** powers * coef).sum(axis=-1)
+        dpowers = np.maximum(powers - 1, 0)
+        df = (powers * x[:, None] ** dpowers * coef).sum(axis=-1)
+        if exponential:
+            f = np.exp(f)
+            df = f * df
+        return f, df
+
+    for crush, mask, x, row in zip(transients, masks, xs, coef):
+        fit_stress = np.full(len(mask), np.nan)
+        stiffness = np.full(len(mask), np.nan)
+        fit_stress[mask], stiffness[mask] = evaluate(row, x)
+        crush['Fit Stress (MPa)'] = fit_stress
+        crush['Stiffness (MPa)'] = stiffness
+    crushes['Data'] = object_series(transients, crushes.index)
+
+    coefficients = pd.DataFrame(coef, index=crushes.index,
+                                columns=pd.Index(powers, name='Power'))
+
+    percent_x = np.array([x * 0.1 for x in range(0, 11)])
+    percent_y, percent_dy = evaluate(coef[:, None, :], percent_x)
+    index = pd.MultiIndex.from_product(
+        [crushes.index, percent_x], names=[crushes.index.name, 'Strain'])
+    percentiles = pd.DataFrame({'Fit Stress (MPa)': percent_y.ravel(),
+                                'Stiffness (MPa)': percent_dy.ravel()},
+                               index=index)
+    return coefficients, percentiles
+
+
 def tare_force(crush):
     """
     Accepts crush dataframe, shifts to account for hanging load and returns
     """
+    crush = transient(crush)
     tare = hanging_force(crush)
     if abs(tare) >= 0.25:
         set_trace()
@@ -479,8 +997,9 @@ def trim_time(crush, lead_time):
     Accepts crush dataframe, trims N sec before contact and after release
     """
     lead_time = pd.Timedelta(lead_time)
-    crush = crush[crush.index >= (contact_time(crush) - lead_time)]
-    crush = crush[crush.index < release_time(crush)]
+    times = stage_times(crush)
+    crush = crush[crush.index >= (times[1] - lead_time)]
+    crush = crush[crush.index < times[3]]
     return crush
 
 
@@ -489,6 +1008,7 @@ def rezero(crush, offset=0, zero_index=None):
     Rezeros the index with an optional offset from zero
     Can optionally specify an index to be zero other than the first
     """
+    crush = transient(crush)
     if zero_index is None:
         zero_index = crush.index[0]
     offset = pd.Timedelta(offset)
@@ -515,76 +1035,375 @@ def select_stage(crush, stage):
     return crush.loc[crush['Stage'] == stage, :]
 
 
-def modify(crushes):
+def recalibrate(crushes, study, applied=None):
+    """
+    Reconverts the force of each crush with the load cell calibration in
+    effect on its procedure date, see crush_cal
+    Sensor readings are taken from the Voltage column if recorded, else
+    force was converted when recorded with the applied calibration, the
+    latest by default, which is inverted to recover the readings
+    study_data() already does this for files with a Voltage column
+    All crushes are converted in one pass, run before modify()
+    Transients are changed from the files so do not use the modify() cache
+    """
+    if applied is None:
+        applied = crush_cal.latest()
+    calibrations = study_calibrations(study, crushes['Test ID'])
+    transients = [transient(crush) for crush in crushes['Data']]
+    lengths = [len(crush) for crush in transients]
+
+    def readings(crush):
+        if 'Voltage' in crush.columns:
+            return crush['Voltage'].to_numpy(dtype=np.float64)
+        force = crush['Force (N)'].to_numpy(dtype=np.float64)
+        return np.round((force - applied.offset) / applied.slope)
+
+    voltage = np.concatenate([readings(crush) for crush in transients])
+    slope = np.repeat([cal.slope for cal in calibrations], lengths)
+    offset = np.repeat([cal.offset for cal in calibrations], lengths)
+    force = np.round(slope * voltage + offset, 6)
+
+    for crush, values in zip(transients,
+                             np.split(force, np.cumsum(lengths)[:-1])):
+        crush['Force (N)'] = values
+    crushes['Data'] = object_series(transients, crushes.index)
+    return crushes
+
+
+def modify_transient(crush):
+    """
+    Applies all modifications to a single crush transient and returns it
+    """
+    return modify_transients([crush])[0]
+
+
+def modify_transients(transients, workers=None, columns=DERIVED_COLUMNS,
+                      dtype=np.float64, files=None):
+    """
+    Applies all modifications to a list of crush transients and returns
+    them, the same as tare_force, smooth_force, add_pressure, add_stress,
+    add_strain and add_stiffness in turn but in a single pass over each
+    transient, smoothing force for all transients at once
+    Only the derived columns listed are added, as arrays of dtype
+    Raises ValueError for excessive hanging force, naming the transient's
+    file if a list of files is given
+    """
+    pin_area = np.pi * (PIN_DIAM / 2) ** 2
+    transients = [transient(crush) for crush in transients]
+
+    # Tare force and split before and after the release stage for smoothing
+    indexes = []
+    tared = []
+    segments = []
+    for i, crush in enumerate(transients):
+        force = crush['Force (N)'].to_numpy(dtype=np.float64)
+        indexes.append(stage_index(crush))
+        contact = stage_start(crush, 1, indexes[i])
+        tare = force[:contact].mean() if contact else force[0]
+        if abs(tare) >= 0.25:
+            name = f'transient {i}' if files is None else files[i]
+            raise ValueError(f'Excessive hanging force of {tare:.3f} N '
+                             f'detected in {name}')
+        force = force - tare
+        rel = stage_start(crush, 3, indexes[i])
+        tared.append(force)
+        segments += [force[:rel], force[rel:]]
+    segments = filtfilt_segments(segments, workers)
+
+    for i, crush in enumerate(transients):
+        force = np.concatenate(segments[2 * i:2 * i + 2])
+        stage = crush['Stage'].to_numpy()
+        position = crush['Position (mm)'].to_numpy()
+        thickness = abs(position[stage_start(crush, 1, indexes[i])])
+        derived = {}
+
+        stress = np.divide(force, pin_area, out=np.empty(len(force), dtype))
+        stress[(stage == 0) | (stage == 3)] = 0
+        strain = np.subtract(thickness, np.abs(position),
+                             out=np.empty(len(force), dtype))
+        strain /= thickness
+        strain[strain < 0] = 0
+
+        if 'Raw Force (N)' not in crush.columns:
+            derived['Raw Force (N)'] = tared[i].astype(dtype, copy=False)
+        pressure = np.multiply(force, 1000, out=np.empty(len(force), dtype))
+        pressure /= pin_area
+        derived['Pressure (kPa)'] = pressure
+        derived['Stress (MPa)'] = stress
+        derived['Strain'] = strain
+        if 'Stiffness (MPa)' in columns:
+            derived['Stiffness (MPa)'] = stiffness_values(
+                stage, strain, stress, out=np.empty(len(force), dtype))
+
+        crush['Force (N)'] = force
+        for name in DERIVED_COLUMNS:
+            if name in columns and name in derived:
+                crush[name] = derived[name]
+    return transients
+
+
+def modify(crushes, cache=None, workers=None, columns=DERIVED_COLUMNS,
+           dtype=np.float64):
     """
     Accepts crushes dataframe, modifies transient data and returns
+    Only the derived columns listed are added, as arrays of dtype, all are
+    needed by calculate()
+    Force smoothing can be spread over a number of worker threads
+    If a cache folder is given modified transients are stored there and
+    read back instead of being modified again, keyed by the source file and
+    calibration so transients must be unchanged from study_data(), and
+    crushes must have the File and Calibration columns it adds
+    Transient handles from a lazy study_data() are replaced by dataframes,
+    filter crushes first so only the transients needed are read
     """
-    crushes['Data'] = crushes['Data'].apply(tare_force)
-    crushes['Data'] = crushes['Data'].apply(smooth_force)
-    crushes['Data'] = crushes['Data'].apply(add_pressure)
-    crushes['Data'] = crushes['Data'].apply(add_stress)
-    crushes['Data'] = crushes['Data'].apply(add_strain)
-    crushes['Data'] = crushes['Data'].apply(add_stiffness)
+    transients = list(crushes['Data'])
+    if cache is None:
+        files = list(crushes['File']) if 'File' in crushes else None
+        transients = modify_transients(transients, workers, columns, dtype,
+                                       files)
+    else:
+        files = list(crushes['File'])
+        name = cache_name('modify', columns, dtype)
+        paths = [cache_path(cache, name, file, calibration, MODIFY_STEPS)
+                 for file, calibration
+                 in zip(files, crushes['Calibration'])]
+        missing = []
+        for i, path in enumerate(paths):
+            if path.exists():
+                transients[i] = pd.read_pickle(path)
+            else:
+                missing.append(i)
+        modified = modify_transients([transients[i] for i in missing],
+                                     workers, columns, dtype,
+                                     [files[i] for i in missing])
+        for i, crush in zip(missing, modified):
+            cache_store(paths[i], crush)
+            transients[i] = crush
+
+    crushes['Data'] = object_series(transients, crushes.index)
     return crushes
 
 
-def calculate(crushes):
+# Features added to each crush by calculate(), name: (function, version)
+FEATURES = {}
+
+
+def feature(name, version=1):
     """
-    Adds calculated statistics about each crush transient and returns
-    Suggest running modify() first to get expected results
+    Registers a function of a crush transient as a feature to calculate
+    The function is called with the transient and its stage_index as index
+    Increment version when the function changes to invalidate cached values
     """
+    def register(func):
+        FEATURES[name] = (func, version)
+        return func
+    return register
+
+
+def to_stress(force):
+    pin_area = np.pi * (PIN_DIAM / 2) ** 2
+    return force / pin_area
+
+
+def to_strain(delta, length):
+    delta, length = abs(delta), abs(length)
+    return delta / length  # compressive positive
+
+
+# Tissue thickness
+@feature('Thickness (mm)')
+def thickness(crush, index=None):
+    return abs(contact_position(crush, index))
+
+
+# Crush and target duration
+feature('Crush Duration (s)')(crush_duration)
+feature('Target Duration (s)')(target_duration)
+
+
+@feature('Target Stress (MPa)')
+def target_stress(crush, index=None):
+    return crush.loc[target_time(crush, index), 'Stress (MPa)']
 
-    def to_stress(force):
-        pin_area = np.pi * (PIN_DIAM / 2) ** 2
-        return force / pin_area
 
-    def to_strain(delta, length):
-        delta, length = abs(delta), abs(length)
-        return delta / length  # compressive positive
+@feature('Target Strain')
+def target_strain(crush, index=None):
+    return crush.loc[target_time(crush, index), 'Strain']
 
-    for i, num in enumerate(crushes.index):
-        crush = crushes.loc[num, 'Data']
 
-        # Tissue thickness
-        thickness = abs(contact_position(crush))
-        crushes.loc[num, 'Thickness (mm)'] = thickness
+# Stiffness at contact
+# Assumed to be minimum
+@feature('Contact Stiffness (MPa)')
+def contact_stiffness(crush, index=None):
+    return crush['Stiffness (MPa)'].min()
 
-        # Crush duration
-        crushes.loc[num, 'Crush Duration (s)'] = crush_duration(crush)
 
-        # Target duration
-        delta = target_duration(crush)
-        crushes.loc[num, 'Target Duration (s)'] = delta
+# Stiffness at target
+# Assumed to be maximum
+@feature('Target Stiffness (MPa)')
+def target_stiffness(crush, index=None):
+    return crush['Stiffness (MPa)'].max()
 
-        # Target stress
-        target_stress = crush.loc[target_time(crush), 'Stress (MPa)']
-        crushes.loc[num, 'Target Stress (MPa)'] = target_stress
 
-        # Target strain
-        target_strain = crush.loc[target_time(crush), 'Strain']
-        crushes.loc[num, 'Target Strain'] = target_strain
+# Delta stress after target reached
+@feature('Relaxation Stress (MPa)')
+def relaxation_stress(crush, index=None):
+    return to_stress(target_relaxation(crush, index))
 
-        # Stiffness at contact
-        # Assumed to be minimum
-        stiffness = crush['Stiffness (MPa)'].min()
-        crushes.loc[num, 'Contact Stiffness (MPa)'] = stiffness
 
-        # Stiffness at target
-        # Assumed to be maximum
-        stiffness = crush['Stiffness (MPa)'].max()
-        crushes.loc[num, 'Target Stiffness (MPa)'] = stiffness
+# Delta strain after target reached
+@feature('Holding Strain')
+def holding_strain(crush, index=None):
+    if index is None:
+        index = stage_index(crush)
+    return to_strain(target_movement(crush, index), thickness(crush, index))
 
-        # Delta stress after target reached
-        stress_relaxation = to_stress(target_relaxation(crush))
-        crushes.loc[num, 'Relaxation Stress (MPa)'] = stress_relaxation
 
-        # Delta strain after target reached
-        holding_strain = to_strain(target_movement(crush), thickness)
-        crushes.loc[num, 'Holding Strain'] = holding_strain
+def crush_statistics(crush):
+    """
+    Returns a dict of all registered features of a crush transient
+    The stage index is found once and passed to every feature
+    """
+    index = stage_index(crush)
+    return {name: func(crush, index) for name, (func, _) in FEATURES.items()}
+
 
+def calculate_steps():
+    # Steps and features the results of calculate() depend on
+    return MODIFY_STEPS + ('calculate',) + tuple(FEATURES)
+
+
+def calculate(crushes, cache=None):
+    """
+    Adds calculated statistics about each crush transient and returns
+    Each registered feature is calculated for all crushes, then added as a
+    column at once
+    Suggest running modify() first to get expected results
+    If a cache folder is given statistics are stored there and read back
+    instead of being calculated again, keyed by the source file and
+    calibration so transients must be as returned by modify(), separately
+    for each choice of derived columns and dtype, and crushes must have the
+    File and Calibration columns added by study_data()
+    Changes made to transients in memory are not seen by the cache, so do
+    not use it after e.g. recalibrate(), fit_stiffness() or trim_time()
+    """
+    if cache is None:
+        statistics = [crush_statistics(crush) for crush in crushes['Data']]
+    else:
+        statistics = []
+        for file, calibration, crush in zip(crushes['File'],
+                                            crushes['Calibration'],
+                                            crushes['Data']):
+            # Options used by modify() are taken from the transient
+            name = cache_name('calculate',
+                              [column for column in DERIVED_COLUMNS
+                               if column in crush.columns],
+                              crush['Stress (MPa)'].dtype)
+            statistics.append(cached(cache, name, file, calibration,
+                                     calculate_steps(), crush_statistics,
+                                     crush))
+
+    columns = {name: [] for name in FEATURES}
+    for stats in statistics:
+        for name, values in columns.items():
+            values.append(stats[name])
+
+    for name, values in columns.items():
+        crushes[name] = np.array(values)
     return crushes
 
 
+def refresh(store, study=None, workers=None):
+    """
+    Returns crushes the same as calculate(modify(study_data(study))) but
+    kept up to date in a store folder, so only new or changed files are
+    read and processed, crushes of files no longer found are dropped
+    The store holds the crushes dataframe and a manifest of the files it
+    was made from with their size, modification time, content hash, the
+    load cell calibration and the processing step versions used
+    Meta data is always taken from the study outline, read from PATH if
+    not given, so changes to the master list apply to all crushes
+    """
+    store = Path(store)
+    if study is None:
+        study = study_outline(PATH)
+    version = step_versions(calculate_steps())
+    manifest = read_manifest(store)
+    stored = pd.DataFrame(index=pd.Index([], name='File'))
+    if (store / 'crushes.pkl').exists():
+        stored = pd.read_pickle(store / 'crushes.pkl').set_index('File')
+
+    # Compare files with the manifest, hashing only those that were touched
+    files = study_files(study)
+    crushes = study_table(study, files)
+    entries = []
+    current = []
+    for file, calibration in zip(crushes['File'], crushes['Calibration']):
+        size, modified = file_stat(file)
+        entry = manifest.get(file)
+        if entry is not None and entry[:2] == (size, modified):
+            digest = entry[2]
+        else:
+            digest = file_hash(file)
+        entries.append((size, modified, digest, calibration, version))
+        current.append(entry is not None and
+                       entry[2:] == (digest, calibration, version) and
+                       file in stored.index)
+    current = np.array(current, dtype=bool)
+
+    # Process new and changed files
+    new = crushes[~current].copy()
+    new['Data'] = object_series(
+        read_transients(new['File'], workers, calibrations=study_calibrations(
+            study, new['Test ID'])), new.index)
+    new = calculate(modify(new, workers=workers))
+
+    # Take everything else from the store
+    kept = crushes[current].copy()
+    if len(kept):
+        rows = stored.loc[kept['File']]
+        kept['Data'] = object_series(list(rows['Data']), kept.index)
+        for name in rows.columns:
+            if name not in kept.columns:
+                kept[name] = rows[name].values
+
+    crushes = pd.concat([kept, new]).loc[crushes.index]
+    crushes.index.name = 'Crush'
+
+    store.mkdir(parents=True, exist_ok=True)
+    cache_store(store / 'crushes.pkl', crushes)
+    write_manifest(store, crushes['File'], entries)
+    return crushes
+
+
+def read_manifest(store):
+    """
+    Returns the manifest of a refresh() store as a dict of file path to
+    (size, modification time, hash, calibration, step versions)
+    """
+    path = Path(store) / 'manifest.csv'
+    if not path.exists():
+        return {}
+    manifest = pd.read_csv(path, dtype={'Hash': str, 'Calibration': str,
+                                        'Version': str})
+    if 'Calibration' not in manifest:
+        manifest['Calibration'] = None  # older store, refresh every file
+    return {row.File: (int(row.Size), int(row.Modified), row.Hash,
+                       row.Calibration, row.Version)
+            for row in manifest.itertuples()}
+
+
+def write_manifest(store, files, entries):
+    # Writes the manifest of a refresh() store, see read_manifest
+    manifest = pd.DataFrame(list(entries),
+                            columns=['Size', 'Modified', 'Hash',
+                                     'Calibration', 'Version'])
+    manifest.insert(0, 'File', list(files))
+    temp = Path(store) / 'manifest.tmp'
+    manifest.to_csv(temp, index=False)
+    temp.replace(Path(store) / 'manifest.csv')
+
+
 def preprocess(crushes, targets):
     """
     Adds targets for each crush available, removes non-features,
@@ -603,42 +1422,50 @@ def preprocess(crushes, targets):
                     'Patient',
                     'Load (g)',
                     'Summary',
+                    'File',
+                    'Calibration',
                     'Data'] + target_names
     feature_names = list(crushes.columns)
     for ex in excluded_feat:
         if ex in feature_names:
             feature_names.remove(ex)
 
-    # Init new targets
+    # Potential regression targets for every target row
+    delta = np.abs(targets['Absolute Delta (um)'] / 1000)
+    percent_delta = np.abs(targets['Percent Delta'] / 100)
+    thickness = delta / percent_delta
+    values = {'Trauma Score': targets['Trauma Score'],
+              'P Score': targets['P Score'],
+              'Serosa Thickness (mm)': thickness,
+              'Post Serosa Thickness (mm)': thickness - delta,
+              'Serosa Change (mm)': delta,
+              'Percent Serosa Change': percent_delta}
+
+    # Match targets to crushes by four criteria, joined on all at once
+    key = ['Protocol', 'Patient', 'Tissue', 'Load (g)']
+    target_keys = pd.DataFrame({'Protocol': targets['Protocol'].values,
+                                'Patient': targets['Patient Code'].values,
+                                'Tissue': targets['Tissue'].values,
+                                'Load (g)': targets['Load (g)'].values,
+                                'Target Row': np.arange(len(targets))})
+    crush_keys = crushes[key].assign(**{'Crush Row': np.arange(len(crushes))})
+    matches = target_keys.merge(crush_keys, on=key, how='left')
+    counts = matches.groupby('Target Row')['Crush Row'].count().values
+    errors = [f"Target {targets.index[row]} "
+              f"({', '.join(str(v) for v in target_keys.loc[row, key])}): "
+              f"{counts[row]:d} matches found"
+              for row in np.flatnonzero(counts != 1)]
+    if errors:
+        raise ValueError("Matching error, each target must match one "
+                         "crush\n" + "\n".join(errors))
+
+    # Add targets, last column is targets
+    matches = matches.sort_values('Target Row')
+    rows = matches['Crush Row'].to_numpy(dtype=np.int64)
     for name in target_names:
-        crushes[name] = np.nan
-
-    # Match targets to crushes, last column is targets
-    for num in targets.index:
-
-        # Identify matching crushes by four criteria
-        sel = {'PROT': targets.loc[num, 'Protocol'],
-               'CODE': targets.loc[num, 'Patient Code'],
-               'TISS': targets.loc[num, 'Tissue'],
-               'LOAD': targets.loc[num, 'Load (g)']}
-        mask = crushes['Protocol'] == sel['PROT']
-        mask = mask & (crushes['Patient'] == sel['CODE'])
-        mask = mask & (crushes['Tissue'] == sel['TISS'])
-        mask = mask & (crushes['Load (g)'] == sel['LOAD'])
-        assert mask.sum() == 1, f"Matching error: {mask.sum():d} matches found"
-
-        # Add potential regression targets
-        delta = np.abs(targets.loc[num, 'Absolute Delta (um)'] / 1000)
-        percent_delta = np.abs(targets.loc[num, 'Percent Delta'] / 100)
-        thickness = delta / percent_delta
-        crushes.loc[mask, 'Serosa Thickness (mm)'] = thickness
-        crushes.loc[mask, 'Post Serosa Thickness (mm)'] = thickness - delta
-        crushes.loc[mask, 'Serosa Change (mm)'] = delta
-        crushes.loc[mask, 'Percent Serosa Change'] = percent_delta
-
-        # Add classifier targets
-        for name in target_names[:2]:
-            crushes.loc[mask, name] = targets.loc[num, name]
+        column = np.full(len(crushes), np.nan)
+        column[rows] = np.asarray(values[name], dtype=np.float64)
+        crushes[name] = column
 
     # Make a copy of features and targets removing any without pathology rating
     valid = ~crushes['Trauma Score'].isna()
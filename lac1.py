@@ -6,6 +6,11 @@
 
 
 import time
+import asyncio
+import threading
+from functools import partial
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from serial import Serial
 from serial.tools import list_ports
 
@@ -34,8 +39,13 @@ FR = 1
 WS_PERIOD_MS = 25
 # LAC-1 manual recommends a small delay of 100 ms after sending commands
 SERIAL_SEND_WAIT_SEC = 0.100
+# Read only commands that can be sent back to back once '>' is received
+QUERY_CMDS = ('TP', 'TV', 'TA', 'TQ', 'TE', 'TT', 'TK')
 # Each line cannot exceed 127 characters as per LAC-1 manual
 SERIAL_MAX_LINE_LENGTH = 127
+# Macro used to stream telemetry and how long to let output drain on abort
+STREAM_MACRO = 10
+STREAM_SETTLE_SEC = 0.010
 
 
 # Class definition using above constants
@@ -54,13 +64,21 @@ class LAC1(object):
     """
 
     def __init__(self, port, baudRate=19200,
-                 silent=True, reset=False, sleepfunc=None):
+                 silent=True, reset=False, sleepfunc=None,
+                 send_wait=SERIAL_SEND_WAIT_SEC):
         """
         If silent is True, then no debugging output will be printed.
 
+        send_wait is the guard delay in seconds between sending motion or
+        configuration commands without waiting for a response and sending
+        the next commands, see sendcmds.
+
         If sleepfunc is not None, then it will be used instead of time.sleep.
         It will be passed the number of seconds to sleep for. This is provided
         for integration with single threaded GUI applications.
+
+        If port is not a device name it is used as an already open serial port,
+        e.g. a lac1_sim.SimulatedLAC1 to run without hardware.
         """
 
         # Store commands to chain together when communication latency
@@ -70,24 +88,46 @@ class LAC1(object):
         # Store last known position for travel range checking
         self._current_pos_enc = None
 
+        # Bytes read from the port not yet returned as a line
+        self._rxbuf = bytearray()
+
+        # Telemetry streamed by a controller macro, see start_stream
+        self._stream_macro = None
+        self._stream_thread = None
+        self._stream_stop = threading.Event()
+        self._stream_cond = threading.Condition()
+        self._stream_samples = deque(maxlen=1000)
+        self._stream_error = None  # raised by read_stream if reading failed
+
         if sleepfunc is not None:
             self._sleepfunc = sleepfunc
         else:
             self._sleepfunc = time.sleep
         self._silent = silent
+        self._send_wait = send_wait
+        # perf_counter_ns times the last commands were sent and the prompt
+        # received, and of the last sample returned by read_movement_and_force
+        self.sent_ns = None
+        self.reply_ns = None
+        self.sample_ns = None
+        # True once the prompt for the last commands sent has been read
+        self._acknowledged = False
 
         print(f'Connecting to LAC-1 on {port} ({baudRate})')
-        port_options = []
-        for option in list_ports.comports():
-            port_options.append(option.device)
-        assert port in port_options, 'Serial port not recognized'
-        self._port = Serial(
-            port=port,
-            baudrate=baudRate,
-            bytesize=8,
-            stopbits=1,
-            parity='N',
-            timeout=0.1)
+        if isinstance(port, str):
+            port_options = []
+            for option in list_ports.comports():
+                port_options.append(option.device)
+            assert port in port_options, 'Serial port not recognized'
+            self._port = Serial(
+                port=port,
+                baudrate=baudRate,
+                bytesize=8,
+                stopbits=1,
+                parity='N',
+                timeout=0.1)
+        else:
+            self._port = port
         self._last_serial_send_time = time.time()
 
         # Reset then setup initial parameters
@@ -108,6 +148,34 @@ class LAC1(object):
         print(f'Successfully connected to LAC-1 on {port} ({baudRate})')
 
     # Communication methods
+    def _fill(self):
+        '''
+        Reads all bytes waiting on the port into the receive buffer, blocking
+        for up to the port timeout if there are none. Returns False if the
+        read timed out without receiving anything.
+        '''
+        data = self._port.read(max(self._port.in_waiting, 1))
+        self._rxbuf += data
+        return len(data) > 0
+
+    def _nextline(self, stop_on_prompt=True):
+        '''
+        Removes and returns the first complete line in the receive buffer,
+        or None if the buffer does not hold one yet. See _readline.
+        '''
+        end = self._rxbuf.find(b'\r')
+        if stop_on_prompt:
+            prompt = self._rxbuf.find(b'>')
+            if prompt != -1 and (end == -1 or prompt < end):
+                line = self._rxbuf[:prompt + 1]
+                del self._rxbuf[:prompt + 1]
+                return line.replace(b'\n', b'').decode('utf-8')
+        if end == -1:
+            return None
+        line = self._rxbuf[:end]
+        del self._rxbuf[:end + 1]
+        return line.replace(b'\n', b'').decode('utf-8')
+
     def _readline(self, stop_on_prompt=True):
         '''
         Returns a line, that is reads until \r. Note that there are
@@ -119,29 +187,20 @@ class LAC1(object):
         including the '>'. The method self._port.readline() is not used b/c
         the escape character can not be set.
 
-        The loop below implicitly handles timeouts b/c when c == '' due to
-        timeout, line += '' is a null op, and the loop continues indefinitely
-        until exit conditions are met.
+        Bytes are read in bulk into a buffer and split into lines, anything
+        after the returned line is kept for the next call. Reads that time
+        out without data are counted until 30 s worth have elapsed.
         '''
 
-        done = False
-        line = str()
         allowedtimeouts = int(30 / self._port.timeout)
 
-        while not done:
-            c = self._port.read().decode('utf-8')
-            if c == '\n':
-                continue
-            elif c == '\r':
-                done = True
-            elif c == '':
+        line = self._nextline(stop_on_prompt)
+        while line is None:
+            if not self._fill():
                 allowedtimeouts -= 1
                 if allowedtimeouts == 0:
                     raise Exception('Serial read timed out')
-            else:
-                line += c
-                if stop_on_prompt and c == '>':
-                    done = True
+            line = self._nextline(stop_on_prompt)
 
         if len(line) and line[0] == '?':
             raise Exception(f'LAC-1 Error: {line[1:]}')
@@ -174,6 +233,11 @@ class LAC1(object):
         If callback is not None, and wait is True, then after reading
         each line from the LAC-1, the callback will be invoked with the
         contents of the line.
+
+        Commands are paced by type. Read only queries (QUERY_CMDS) sent after
+        the prompt for the previous commands was received go out immediately.
+        Otherwise the port buffers are flushed and, if the previous commands
+        were not waited on, sending is delayed until send_wait has elapsed.
         """
 
         assert self._port is not None, 'Serial communication disconnected'
@@ -205,28 +269,47 @@ class LAC1(object):
             self._chain_cmds = cmds
             return
 
-        # Send commands over serial connection
+        # The port is shared with the stream reader so pause it to send
+        if self._stream_macro is not None:
+            self._pause_stream()
+            try:
+                return self._send(cmds, wait, callback)
+            finally:
+                self._resume_stream()
+        return self._send(cmds, wait, callback)
+
+    def _send(self, cmds, wait, callback):
+        """
+        Sends the formatted commands over the serial connection, see sendcmds.
+        """
+        tosend = ','.join(cmds)
+        query = self._acknowledged and all(
+            cmd[:2] in QUERY_CMDS for cmd in tosend.split(','))
+
         now = time.time()
-        if self._last_serial_send_time is not None:
+        if not query and self._last_serial_send_time is not None:
             dt = now - self._last_serial_send_time
-            timeleft = SERIAL_SEND_WAIT_SEC - dt
+            timeleft = self._send_wait - dt
             if timeleft > 0:
                 self._sleepfunc(timeleft)
 
-        tosend = ','.join(cmds)
         if not self._silent:
             print('[<]', tosend)
 
-        self._port.flushInput()
-        self._port.flushOutput()
+        if not query:
+            self._port.flushInput()
+            self._port.flushOutput()
+            self._rxbuf.clear()
 
         assert len(tosend) <= SERIAL_MAX_LINE_LENGTH, (
             'Command exceeds allowed line length')
 
         self._port.write(bytearray(tosend + '\r', 'utf-8'))
+        self.sent_ns = time.perf_counter_ns()
 
         # Reset chain cmds
         self._chain_cmds = []
+        self._acknowledged = False
 
         datalines = []
         if wait:
@@ -235,6 +318,8 @@ class LAC1(object):
                 line = self._readline()
                 if line == '>':
                     done = True
+                    self._acknowledged = True
+                    self.reply_ns = time.perf_counter_ns()
                 elif line is not None and len(line):
                     if callback is not None:
                         callback(line)
@@ -493,20 +578,136 @@ class LAC1(object):
         Combines two simultaneous reads: position and force, to allow chaining.
         Torque is also read as an indirect metric of force (units arbitrary).
         Return units are position in mm and force in N.
+        The time of the sample is set in sample_ns, in perf_counter_ns time
+        midway between sending the query and receiving the reply.
         """
+        if self._stream_macro is not None:
+            self.sample_ns, sample = self.read_stream()[-1]
+            return sample
+
         raw_output = self.sendcmds('TP,TV,TA8,TQ')
 
         assert len(raw_output) == 4, 'Read error'
+        self.sample_ns = (self.sent_ns + self.reply_ns) // 2
 
+        return self._parse_movement_and_force(raw_output)
+
+    def _parse_movement_and_force(self, raw_output):
         self._current_pos_enc = int(raw_output[-4])
         return [self._current_pos_enc / ENC_COUNTS_PER_MM,
                 int(raw_output[-3]) / KV,
                 raw_output[-2],  # analog voltage
                 int(raw_output[-1])]
 
+    # Streaming methods
+    def start_stream(self, interval_ms=10, macro=STREAM_MACRO):
+        """
+        Downloads a macro to the LAC-1 that repeatedly reports position,
+        velocity, force and torque every interval_ms and starts it running.
+
+        A reader thread timestamps and queues each report. While streaming,
+        read_movement_and_force returns the newest report instead of querying
+        the LAC-1, and sendcmds pauses the macro to send other commands.
+        """
+        if self._stream_macro is not None:
+            self.stop_stream()
+
+        self.sendcmds('MD', macro, chain=True)
+        self.sendcmds('TP,TV,TA8,TQ', chain=True)
+        self.wait(interval_ms, chain=True)
+        self.sendcmds('MJ', macro)
+
+        with self._stream_cond:
+            self._stream_samples.clear()
+        self._stream_macro = macro
+        self._resume_stream()
+
+    def stop_stream(self):
+        """
+        Stops the streaming macro and reader thread if running.
+        """
+        if self._stream_macro is not None:
+            self._pause_stream()
+            self._stream_macro = None
+
+    def read_stream(self, timeout=30):
+        """
+        Returns a list of (perf_counter_ns time, sample) for each report
+        received since the last call, oldest first, waiting for one if there
+        are none. Samples are in the format returned by read_movement_and_force
+        and timed when the first value of the report is received.
+        Raises the error that stopped the reader thread once its samples have
+        been returned.
+        """
+        with self._stream_cond:
+            if not self._stream_cond.wait_for(
+                    lambda: self._stream_samples or self._stream_error,
+                    timeout):
+                raise Exception('Stream read timed out')
+            if not self._stream_samples:
+                raise self._stream_error
+            samples = list(self._stream_samples)
+            self._stream_samples.clear()
+        return samples
+
+    def _pause_stream(self):
+        self._stream_stop.set()
+        self._stream_thread.join()
+        self._stream_thread = None
+
+        # Abort macro, let any partial report drain and discard it
+        self._port.write(bytearray('\033', 'utf-8'))
+        self._sleepfunc(STREAM_SETTLE_SEC)
+        self._port.flushInput()
+        self._rxbuf.clear()
+        self._acknowledged = False
+
+    def _resume_stream(self):
+        self._port.write(bytearray(f'MS{self._stream_macro}\r', 'utf-8'))
+        self._acknowledged = False
+
+        self._stream_stop.clear()
+        self._stream_error = None
+        self._stream_thread = threading.Thread(target=self._stream_reader,
+                                               daemon=True)
+        self._stream_thread.start()
+
+    def _stream_reader(self):
+        '''
+        Groups lines emitted by the streaming macro into samples of four
+        values until asked to stop. An error, e.g. a line that is not a
+        value, stops the thread and is passed on to read_stream.
+        '''
+        values = []
+        try:
+            while not self._stream_stop.is_set():
+                line = self._nextline(stop_on_prompt=False)
+                if line is None:
+                    self._fill()
+                    continue
+                elif not len(line):
+                    continue
+
+                if not values:
+                    received_ns = time.perf_counter_ns()
+                values.append(line)
+                if len(values) == 4:
+                    sample = (received_ns,
+                              self._parse_movement_and_force(values))
+                    values = []
+                    with self._stream_cond:
+                        self._stream_samples.append(sample)
+                        self._stream_cond.notify_all()
+        except Exception as error:
+            with self._stream_cond:
+                self._stream_error = error
+                self._stream_cond.notify_all()
+
     # Shutdown methods
     def close(self):
         if self._port is not None:
+            self.stop_stream()
+
             # Send escape char twice
             for _ in range(2):
                 self._port.write(bytearray('\033', 'utf-8'))
@@ -516,3 +717,79 @@ class LAC1(object):
 
             self._port.close()
             self._port = None
+
+
+class AsyncLAC1(object):
+    """
+    asyncio interface to a SMAC LAC-1 module.
+
+    Wraps a LAC1 and runs its methods in a single worker thread, so calls
+    are sent to the port one at a time without blocking the event loop.
+    Every LAC1 method is available as a coroutine taking the same arguments,
+    e.g. await rig.move_clear(5) or await rig.read_movement_and_force().
+
+    Use AsyncLAC1.open to connect, which accepts the LAC1 arguments.
+    """
+
+    def __init__(self, rig, executor=None):
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=1)
+        self.rig = rig
+        self._executor = executor
+
+    @classmethod
+    async def open(cls, port, **kwargs):
+        """
+        Connects to the LAC-1 on port without blocking the event loop.
+        """
+        executor = ThreadPoolExecutor(max_workers=1)
+        loop = asyncio.get_running_loop()
+        rig = await loop.run_in_executor(executor,
+                                         partial(LAC1, port, **kwargs))
+        return cls(rig, executor)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def __getattr__(self, name):
+        attr = getattr(self.rig, name)
+        if not callable(attr):
+            return attr
+
+        async def method(*args, **kwargs):
+            return await self._call(attr, *args, **kwargs)
+        method.__name__ = name
+        method.__doc__ = attr.__doc__
+        return method
+
+    def _call(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(self._executor,
+                                    partial(func, *args, **kwargs))
+
+    async def telemetry(self, interval_ms=None):
+        """
+        Asynchronously yields (perf_counter_ns time, sample) for each sample
+        in the format returned by read_movement_and_force. Samples are
+        streamed by the LAC-1 every interval_ms if given, otherwise each is
+        requested as soon as the previous one is received.
+        """
+        if interval_ms is None:
+            while True:
+                sample = await self.read_movement_and_force()
+                yield self.rig.sample_ns, sample
+
+        await self.start_stream(interval_ms)
+        try:
+            while True:
+                for sample in await self.read_stream():
+                    yield sample
+        finally:
+            await self.stop_stream()
+
+    async def close(self):
+        await self._call(self.rig.close)
+        self._executor.shutdown()
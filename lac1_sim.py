@@ -0,0 +1,399 @@
+#!/usr/bin/env python
+
+'''
+Simulated LAC-1 controller for running the rig without hardware.
+
+SimulatedLAC1 stands in for the serial.Serial port used by lac1.LAC1 and
+emulates enough of the LAC-1 command grammar to run crush.py protocols:
+replies are timed as if sent over a serial line so the sample rate of the
+control loop can be measured and compared between changes.
+
+Written by Matt MacDonald
+For CIGITI at the Hospital for Sick Children Toronto
+'''
+
+
+import re
+import math
+import time
+import random
+import threading
+from collections import deque
+
+from lac1 import ENC_COUNTS_PER_MM, STAGE_TRAVEL_MM, KV, KA
+
+
+# Bits sent per byte with 8N1 framing (start + 8 data + stop)
+BITS_PER_BYTE = 10
+# Time for the controller to execute a single command
+COMMAND_DELAY_SEC = 0.0005
+# Speed the rod falls toward full extension when the motor is off
+FALL_VELOCITY_MM = 10.0
+# Arbitrary scaling of load cell force to reported motor torque
+TORQUE_PER_N = 400
+ESCAPE = 0x1b
+
+_token_pattern = re.compile(r'^(?P<cmd>[A-Z]{2})(?P<arg>-?\d*)$')
+
+
+class TissueModel(object):
+    """
+    Exponential stress strain model of tissue resting on the crush plate.
+
+    Force in N is a * (exp(b * strain) - 1) where strain is the fraction of
+    thickness compressed by the rod. Position 0 is full extension (the plate)
+    so contact occurs at -thickness mm.
+    """
+
+    def __init__(self, thickness=3.0, a=0.5, b=6.0):
+        self.thickness = thickness
+        self.a = a
+        self.b = b
+
+    def force(self, position):
+        compression = self.thickness - abs(min(position, 0.0))
+        if compression <= 0:
+            return 0.0
+        strain = compression / self.thickness
+        return self.a * (math.exp(self.b * strain) - 1)
+
+
+class SimulatedLAC1(object):
+    """
+    Serial port stand-in emulating a LAC-1 driving an actuator into tissue.
+
+    Implements the parts of the serial.Serial interface used by LAC1 (read,
+    write, in_waiting, flushInput, flushOutput, close). Commands are executed
+    on a virtual controller clock and every reply byte becomes readable only
+    after the time it would take to arrive at the given baud rate.
+
+    Only the commands used by lac1.py are implemented. Acceleration limits
+    are not modelled, the rod moves at the set velocity or not at all.
+    Unknown commands reply with a '?' error line.
+
+    The load cell on analog channel 8 reports the tissue force converted to
+    ADC counts with calibration (slope, offset) in N per count, clipped to
+    the 10 bit range and optionally with gaussian noise in counts.
+    """
+
+    def __init__(self, tissue=None, baudrate=19200, timeout=0.1,
+                 calibration=(0.02733, -8.3447), noise=0.0, seed=None,
+                 command_delay=COMMAND_DELAY_SEC, name='SIM'):
+        self.name = name
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.is_open = True
+
+        if tissue is None:
+            tissue = TissueModel()
+        self._tissue = tissue
+        self._calibration = calibration
+        self._noise = noise
+        self._random = random.Random(seed)
+        self._byte_time = BITS_PER_BYTE / baudrate
+        self._command_delay = command_delay
+
+        self._cond = threading.Condition()
+        self._rx = deque()  # (available time, byte) to be read by host
+        self._tx_end = 0.0  # time the last reply byte finishes sending
+        self._rx_end = 0.0  # time the last host byte finishes arriving
+        self._line = bytearray()
+        self._clock = time.perf_counter()  # controller time
+        self._reset()
+
+    def __str__(self):
+        return self.name
+
+    def _reset(self):
+        self._echo = True
+        self._macros = {}
+        self._macro = None  # (macro number, index) of running macro
+        self._calls = []
+        self._error = 0
+
+        self._t = self._clock  # time of motion state
+        self._pos = 0.0  # mm from full extension, negative is retracted
+        self._home = 0.0
+        self._vel = 0.0  # mm/s
+        self._target = None  # mm, None if moving without end
+        self._mode = 'PM'
+        self._motor = True
+        self._extend = True
+        self._sv = 0.0
+        self._sa = 0.0
+        self._sq = 0
+        self._target_cmd = 0.0
+
+    # Serial interface
+    @property
+    def in_waiting(self):
+        with self._cond:
+            now = time.perf_counter()
+            self._run_macro(now)
+            return self._available(now)
+
+    def read(self, size=1):
+        deadline = time.perf_counter() + self.timeout
+        with self._cond:
+            while True:
+                now = time.perf_counter()
+                self._run_macro(now)
+                available = self._available(now)
+                if available >= size or now >= deadline:
+                    break
+                if available < len(self._rx):
+                    wake = self._rx[available][0]
+                elif self._macro is not None:
+                    wake = self._clock
+                else:
+                    wake = deadline
+                self._cond.wait(max(min(wake, deadline) - now, 0))
+            count = min(available, size)
+            return bytes(self._rx.popleft()[1] for _ in range(count))
+
+    def write(self, data):
+        with self._cond:
+            now = time.perf_counter()
+            start = max(now, self._rx_end)
+            for i, byte in enumerate(bytes(data)):
+                arrival = start + (i + 1) * self._byte_time
+                if byte == ESCAPE:
+                    self._run_macro(arrival)
+                    self._macro = None
+                    self._calls = []
+                    self._line = bytearray()
+                elif byte == ord('\r'):
+                    line = self._line.decode('utf-8')
+                    self._line = bytearray()
+                    self._run_macro(arrival)
+                    self._run_line(line, arrival)
+                elif byte != ord('\n'):
+                    self._line.append(byte)
+            self._rx_end = start + len(data) * self._byte_time
+            self._cond.notify_all()
+        return len(data)
+
+    def flushInput(self):
+        with self._cond:
+            now = time.perf_counter()
+            self._run_macro(now)
+            for _ in range(self._available(now)):
+                self._rx.popleft()
+
+    def flushOutput(self):
+        pass
+
+    reset_input_buffer = flushInput
+    reset_output_buffer = flushOutput
+
+    def close(self):
+        self.is_open = False
+
+    # Controller
+    def _available(self, now):
+        count = 0
+        for t, _ in self._rx:
+            if t > now:
+                break
+            count += 1
+        return count
+
+    def _emit(self, text):
+        t = max(self._clock, self._tx_end)
+        for byte in text.encode('utf-8'):
+            t += self._byte_time
+            self._rx.append((t, byte))
+        self._tx_end = t
+        self._clock = t  # controller blocks while its output drains
+
+    def _run_line(self, line, arrival):
+        if self._macro is not None:
+            return  # busy running a macro, only escape is accepted
+        self._clock = max(self._clock, arrival)
+        if self._echo:
+            self._emit(line + '\r\n')
+        tokens = [token.strip() for token in line.split(',')]
+        for i, token in enumerate(tokens):
+            if not token:
+                continue
+            if not self._execute(token, tokens[i + 1:]):
+                break
+        if self._macro is None:
+            self._emit('>')
+
+    def _run_macro(self, now):
+        while self._macro is not None and self._clock <= now:
+            number, index = self._macro
+            body = self._macros.get(number, [])
+            if index >= len(body):
+                if self._calls:
+                    self._macro = self._calls.pop()
+                    continue
+                self._macro = None
+                self._emit('>')
+                break
+            self._macro = (number, index + 1)
+            self._execute(body[index], [])
+
+    def _execute(self, token, rest):
+        """
+        Executes a single command at the controller clock. Returns False if
+        the remainder of the line should not be executed.
+        """
+        match = _token_pattern.match(token)
+        if not match:
+            return self._fail(f'Invalid command {token}')
+        cmd = match.group('cmd')
+        arg = match.group('arg')
+        arg = int(arg) if arg else 0
+
+        self._clock += self._command_delay
+        self._update(self._clock)
+
+        if cmd == 'MD':  # rest of line is stored as the macro
+            self._macros[arg] = [token.strip() for token in rest if token]
+            return False
+        elif cmd in ('MS', 'MJ'):
+            self._macro = (arg, 0)
+            return False
+        elif cmd == 'MC':
+            if self._macro is not None:
+                self._calls.append(self._macro)
+            self._macro = (arg, 0)
+            return False
+        elif cmd == 'RM':
+            self._macros = {}
+        elif cmd == 'RT':
+            self._reset()
+        elif cmd == 'EF':
+            self._echo = False
+        elif cmd == 'EN':
+            self._echo = True
+        elif cmd in ('SS', 'SG', 'SI', 'SD', 'IL', 'SE', 'RI', 'FR'):
+            pass  # servo tuning has no effect on the simulation
+        elif cmd == 'SV':
+            self._sv = arg / KV
+            if self._mode == 'VM' and self._vel:
+                self._vel = math.copysign(self._sv, self._vel)
+        elif cmd == 'SA':
+            self._sa = arg / KA
+        elif cmd == 'SQ':
+            self._sq = arg
+        elif cmd == 'DI':
+            self._extend = arg == 0
+        elif cmd in ('PM', 'VM', 'QM'):
+            self._mode = cmd
+        elif cmd == 'MN':
+            self._motor = True
+            self._halt()
+        elif cmd == 'MF':
+            self._motor = False
+            self._move(0.0, FALL_VELOCITY_MM)
+        elif cmd == 'MA':
+            self._target_cmd = arg / ENC_COUNTS_PER_MM + self._home
+        elif cmd == 'MR':
+            self._target_cmd = self._pos + arg / ENC_COUNTS_PER_MM
+        elif cmd == 'GH':
+            self._target_cmd = self._home
+            self._move(self._target_cmd, self._sv)
+        elif cmd == 'DH':
+            self._home = self._pos - arg / ENC_COUNTS_PER_MM
+        elif cmd == 'GO':
+            if not self._motor:
+                pass
+            elif self._mode == 'PM':
+                self._move(self._target_cmd, self._sv)
+            elif self._mode == 'VM':
+                self._move(None, self._sv if self._extend else -self._sv)
+            else:
+                self._halt()  # torque balances the tissue
+        elif cmd in ('ST', 'AB'):
+            if self._motor:
+                self._halt()
+            if cmd == 'AB':
+                self._macro = None
+                self._calls = []
+        elif cmd == 'WA':
+            self._clock += arg / 1000
+        elif cmd == 'WS':
+            self._clock += self._time_to_stop() + arg / 1000
+        elif cmd == 'TP':
+            position = (self._pos - self._home) * ENC_COUNTS_PER_MM
+            self._emit(f'{int(round(position))}\r\n')
+        elif cmd == 'TT':
+            target = (self._target_cmd - self._home) * ENC_COUNTS_PER_MM
+            self._emit(f'{int(round(target))}\r\n')
+        elif cmd == 'TV':
+            self._emit(f'{int(round(self._vel * KV))}\r\n')
+        elif cmd == 'TA':
+            self._emit(f'{self._analog(arg)}\r\n')
+        elif cmd == 'TQ':
+            if self._mode == 'QM':
+                torque = self._sq
+            else:
+                torque = int(TORQUE_PER_N * self._force())
+            self._emit(f'{torque}\r\n')
+        elif cmd == 'TE':
+            self._emit(f'{self._error}\r\n')
+        elif cmd == 'TK':
+            self._emit(f'SV={int(self._sv * KV)},SA={int(self._sa * KA)},'
+                       f'SQ={self._sq}\r\n')
+        else:
+            return self._fail(f'Unknown command {cmd}')
+        return True
+
+    def _fail(self, message):
+        self._error = 1
+        self._emit(f'?{message}\r\n')
+        return False
+
+    # Physics
+    def _force(self):
+        return self._tissue.force(self._pos)
+
+    def _analog(self, channel):
+        if channel != 8:
+            return 0
+        slope, offset = self._calibration
+        counts = (self._force() - offset) / slope
+        if self._noise:
+            counts += self._random.gauss(0, self._noise)
+        return min(max(int(round(counts)), 0), 1023)
+
+    def _move(self, target, velocity):
+        self._target = target
+        if target is not None:
+            velocity = math.copysign(abs(velocity), target - self._pos)
+        self._vel = velocity
+
+    def _halt(self):
+        self._vel = 0.0
+        self._target = None
+
+    def _update(self, t):
+        dt = t - self._t
+        if dt <= 0:
+            return
+        self._t = t
+        if not self._vel:
+            return
+
+        pos = self._pos + self._vel * dt
+        if self._target is not None and (pos - self._target) * self._vel >= 0:
+            pos = self._target
+            self._halt()
+        if pos > 0 or pos < -STAGE_TRAVEL_MM:  # hard stops
+            pos = min(max(pos, -STAGE_TRAVEL_MM), 0.0)
+            self._halt()
+        self._pos = pos
+
+    def _time_to_stop(self):
+        if not self._vel:
+            return 0.0
+        if self._target is not None:
+            end = self._target
+        elif self._vel > 0:
+            end = 0.0
+        else:
+            end = -STAGE_TRAVEL_MM
+        return abs(end - self._pos) / abs(self._vel)